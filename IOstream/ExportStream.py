@@ -10,46 +10,96 @@ import pandas as pd
 
 def saveCluster(Cluster, path, xml=False, overwrite=False):
     """
-    The given Cluster instance is saved to path. For each Cluster Dataframe, 
-    a pickle is saved with attribute name as filename. The Spatial Reference is 
-    saved as ref.txt containing a WKT. Im XML is True, reference is saved as 
-    ref.xml in xml format.
-    If overwrite is True, the given folder at path will RECURSIVLY deleted.
-    Do only set this option to True, if you didn't check the path. Twice.
-    @depracted
-    @ will be converted to a file creating tarballs. files are created as file-like-objects
+    The given Cluster instance is saved to path as a single archive file. 
+    The file starts with a magic string, the length of a JSON header and the 
+    header itself, holding the Spatial Reference as WKT (as XML if xml is 
+    True) and the layout of the data blocks. The shared coordinates are 
+    stored once and each numeric dataset as one raw array, aligned to 64 
+    bytes, thus read_Cluster can memory-map them. Other datasets and directly 
+    set DataFrames are pickled, with geometries stored as WKB.
+    If overwrite is True, an existing file or folder at path will be 
+    RECURSIVLY deleted. Do only set this option to True, if you didn't check 
+    the path. Twice.
     """
+    import json, struct, pickle
+    import numpy as np
+    from ImportStream import _MAGIC, _ALIGN
+    
     if os.path.exists(path):
-        if overwrite:
-            # remove folder recursivley
+        if not overwrite:
+            raise AttributeError("The file {0} at {1} already exists.".format(os.path.basename(path), os.path.dirname(path)))
+        # remove old archive or legacy folder
+        if os.path.isdir(path):
             shutil.rmtree(path)
         else:
-            raise AttributeError("The folder {0} at {1} already exists.".format(os.path.basename(path), os.path.dirname(path)))
+            os.remove(path)
     
-    # Create folder at path
-    os.mkdir(path)
+    ### layout of the data blocks ###
+    ref = Cluster.getSpatialReference()
+    header = {'version': 1, 'datasets': list(Cluster.datasets), 'values': {}, 'objects': {}, 'coordinates': None}
+    if xml:
+        header['xml'] = ref.ExportToXML()
+    else:
+        header['wkt'] = ref.ExportToWkt()
     
-    ### Save all data ###
-    # get all datasets with objects
-    datasets = Cluster.getDatasets(True)
+    blocks = []
+    offset = 0
     
-    for dataset in datasets:
-        namepath = path + "/" + dataset + ".pickle"
-        datasets[dataset].to_pickle(namepath)
+    def add(data):
+        # returns the offset of data, the next block starts aligned
+        start = offset
+        blocks.append((start, data))
+        return start, start + -(-_nbytes(data) // _ALIGN) * _ALIGN
     
-    ### Save Spatial reference ###
-    ref = Cluster.getSpatialReference()
+    coordinates = Cluster.getCoordinates()
+    if coordinates is not None:
+        coordinates = np.ascontiguousarray(coordinates)
+        start, offset = add(coordinates)
+        header['coordinates'] = {'offset': start, 'dtype': coordinates.dtype.str, 'shape': list(coordinates.shape)}
+    header['n'] = 0 if coordinates is None else len(coordinates)
     
-    if xml:
-        filepath = path + "/ref.xml"
-        filecontent = ref.ExportToXML()
-    else:
-        filepath = path + "/ref.wkt"
-        filecontent = ref.ExportToWkt()
+    for name in Cluster.datasets:
+        if name in Cluster._values and Cluster._values[name].dtype.kind in 'biufc':
+            values = np.ascontiguousarray(Cluster._values[name])
+            start, offset = add(values)
+            header['values'][name] = {'offset': start, 'dtype': values.dtype.str, 'shape': list(values.shape)}
+        else:
+            if name in Cluster._values:
+                blob = pickle.dumps(Cluster._values[name], 2)
+                kind = 'values'
+            else:
+                # store OGR geometries as WKB
+                frame = Cluster._frames[name].copy()
+                if 'geometry' in frame.columns:
+                    frame['geometry'] = [None if g is None else g.ExportToWkb() for g in frame.geometry]
+                blob = pickle.dumps(frame, 2)
+                kind = 'frame'
+            start, offset = add(blob)
+            header['objects'][name] = {'offset': start, 'length': len(blob), 'kind': kind}
+    
+    header = json.dumps(header).encode('utf-8')
     
-    fs = open(filepath, "w")
-    fs.write(filecontent)
-    fs.close()
+    ### write the archive ###
+    with open(path, 'wb') as fs:
+        fs.write(_MAGIC)
+        fs.write(struct.pack('<Q', len(header)))
+        fs.write(header)
+        
+        # the data blocks are positioned relative to the aligned data start
+        begin = -(-(len(_MAGIC) + 8 + len(header)) // _ALIGN) * _ALIGN
+        for start, data in blocks:
+            fs.seek(begin + start)
+            if isinstance(data, np.ndarray):
+                data.tofile(fs)
+            else:
+                fs.write(data)
+
+
+def _nbytes(data):
+    """
+    Returns the size of an numpy.ndarray or bytes block.
+    """
+    return data.nbytes if hasattr(data, 'nbytes') else len(data)
     
     
 def exportShp(Object, path, SpatialReference=None, name=None):
@@ -60,6 +110,72 @@ def exportShp(Object, path, SpatialReference=None, name=None):
     """
     from FileHandler import FileHandler
     
+    data, SpatialReference = _exportData(Object, SpatialReference, name, 'locExportShp')
+        
+    ## create shapefiles
+    for dataset in data:
+        FileHandler(path, data[dataset], SpatialReference, name=dataset)
+
+
+def exportGpkg(Object, path, SpatialReference=None, name=None):
+    """
+    Wrapper for Filehandler. 
+    Export result DataFrame of voronoi or delaunay function, or all Cluster 
+    attributes into one GeoPackage name.gpkg in the folder path. Each 
+    dataset is written as a layer with a R-tree spatial index.
+    Returns a dict of layer name and number of features.
+    """
+    from FileHandler import FileHandler
+    
+    data, SpatialReference = _exportData(Object, SpatialReference, name, 'locExportGpkg')
+    
+    if name is None:
+        name = 'locExportGpkg'
+    
+    handler = FileHandler(path, SpatialReference=SpatialReference, driver='GPKG')
+    return handler.createFromDataFrames(data, name)
+
+
+def exportFgb(Object, path, SpatialReference=None, name=None):
+    """
+    Wrapper for Filehandler. 
+    Export result DataFrame of voronoi or delaunay function, or Cluster 
+    attributes to FlatGeobuf. As for exportShp, each dataset is written to 
+    its own file, which includes a packed R-tree spatial index.
+    """
+    from FileHandler import FileHandler
+    
+    data, SpatialReference = _exportData(Object, SpatialReference, name, 'locExportFgb')
+    
+    ## create FlatGeobuf files
+    for dataset in data:
+        FileHandler(path, data[dataset], SpatialReference, driver='FlatGeobuf', name=dataset)
+
+
+def exportChunks(chunks, path, SpatialReference=None, name=None, driver='ESRI Shapefile'):
+    """
+    Wrapper for Filehandler. 
+    Export an iterable of result chunks, each a DataFrame or a tuple of 
+    geometries and values, into one layer of a file name in the folder path. 
+    The chunks are written as they are generated, thus large results need 
+    not be held in memory.
+    Returns the number of features.
+    """
+    from FileHandler import FileHandler
+    
+    if name is None:
+        name = 'locExportChunks'
+    
+    handler = FileHandler(path, SpatialReference=SpatialReference, driver=driver)
+    return handler.createFromChunks(chunks, name)
+
+
+def _exportData(Object, SpatialReference=None, name=None, default='locExport'):
+    """
+    Returns the DataFrames to be exported from Object as dict of dataset 
+    name and DataFrame, and the SpatialReference. For a pandas.DataFrame, 
+    name or default is used as dataset name.
+    """
     ### check Object class ###
     # Object is a locomotif.Cluster
     if isinstance(Object, locomotif.Cluster):
@@ -72,11 +188,8 @@ def exportShp(Object, path, SpatialReference=None, name=None):
         if name is not None:
             data = {name:Object}
         else: 
-            data = {'locExportShp':Object}
+            data = {default:Object}
     else:
         raise TypeError("Object has to be of type locomotif.Cluster or pandas.DataFrame, found {0}".format(Object.__class__))
-        
-    ## create shapefiles
-    for dataset in data:
-        FileHandler(path, data[dataset], SpatialReference, name=dataset)
     
+    return data, SpatialReference
@@ -10,6 +10,9 @@ from datetime import datetime as dt
 import pandas as pd
 import os
 
+# file extension of the supported OGR drivers
+_EXTENSIONS = {'ESRI Shapefile': '.shp', 'GPKG': '.gpkg', 'FlatGeobuf': '.fgb'}
+
 class FileHandler(object):
     """
     """
@@ -53,11 +56,14 @@ class FileHandler(object):
         else:
             self.ref = SpatialReference
         
-        # create Shapefile driver
+        # create the OGR driver
         try:
             self.driver = ogr.GetDriverByName(driver)
         except:
+            self.driver = None
+        if self.driver is None:
             raise TypeError("The driver '{0}' cannot be loaded. Make sure this is a valid OGR driver name and GDAL_DATA is set as environment variable.".format(driver))
+        self.extension = _EXTENSIONS.get(driver, '')
         
         # pass DataFrame if given
         if DataFrame is not None:
@@ -69,67 +75,240 @@ class FileHandler(object):
             
         
         
-    def createFromDataFrame(self, DataFrame, name=None, width=20, precision=5):
+    def createFromDataFrame(self, DataFrame, name=None, width=20, precision=5, batchsize=10000):
         """
-        create ESRI Shapefile from DataFrame. Check the DataFrame for having 
-        an geometry column and various amount of data columns. Name is used as 
-        shp filename.
-        The values are created as a OFTReal field with width and precision
+        create ESRI Shapefile (or a file of the driver given on init) from 
+        DataFrame. Check the DataFrame for having an geometry column and 
+        various amount of data columns. Name is used as filename.
+        The field types are taken from the column dtypes, float columns are 
+        created as a OFTReal field with width and precision.
+        The features are written in transactions of batchsize features.
+        Returns the number of written features.
         """
         # handle file name
         if name is None:
-            name = 'loc{0.year}{0.month}{0.day}{0.hour}{0.minute}{0.second}.shp'.format(dt.now())
-        elif not name.endswith('.shp'):
-            name = name + ".shp"
-         
+            name = 'loc{0.year}{0.month}{0.day}{0.hour}{0.minute}{0.second}'.format(dt.now()) + self.extension
+        elif not name.endswith(self.extension):
+            name = name + self.extension
+        
+        ### create file ###
+        shpfile = self.driver.CreateDataSource(self.path + name)
+        if shpfile is None:
+            raise IOError("The file {0} could not be created.".format(self.path + name))
+        
+        try:
+            # create layer use name as layername
+            numberOfFeatures = self._createLayer(shpfile, name.split('.')[0], DataFrame, width, precision, batchsize)
+        finally:
+            # close the Shapefile
+            shpfile.Destroy()
+        
+        return numberOfFeatures
+    
+    
+    def createFromDataFrames(self, DataFrames, name=None, width=20, precision=5, batchsize=10000):
+        """
+        create one file of the driver given on init, holding one layer for 
+        each DataFrame in DataFrames, a dict of layer name and DataFrame. 
+        Needs a driver supporting multiple layers, like GPKG. Name is used 
+        as filename. Each layer gets a spatial index.
+        Returns a dict of layer name and number of written features.
+        """
+        # handle file name
+        if name is None:
+            name = 'loc{0.year}{0.month}{0.day}{0.hour}{0.minute}{0.second}'.format(dt.now()) + self.extension
+        elif not name.endswith(self.extension):
+            name = name + self.extension
+        
+        ### create file ###
+        datasource = self.driver.CreateDataSource(self.path + name)
+        if datasource is None:
+            raise IOError("The file {0} could not be created.".format(self.path + name))
+        
+        numberOfFeatures = dict()
+        try:
+            for layername in DataFrames:
+                numberOfFeatures[layername] = self._createLayer(datasource, layername, DataFrames[layername], width, precision, batchsize)
+        finally:
+            # close the file
+            datasource.Destroy()
+        
+        return numberOfFeatures
+    
+    
+    def createFromChunks(self, chunks, name=None, width=20, precision=5):
+        """
+        create one layer in a file of the driver given on init from an 
+        iterable of chunks, which is written chunk by chunk. Thus a generator 
+        can be exported without holding all results in memory. A chunk is 
+        either a DataFrame with a 'geom' or 'geometry' column, or a tuple of 
+        geometries and values, a dict or DataFrame of data columns (or None).
+        The fields are created from the first chunk, each chunk is written 
+        in one transaction. Name is used as filename.
+        Returns the number of written features.
+        """
+        # handle file name
+        if name is None:
+            name = 'loc{0.year}{0.month}{0.day}{0.hour}{0.minute}{0.second}'.format(dt.now()) + self.extension
+        elif not name.endswith(self.extension):
+            name = name + self.extension
+        
+        ### create file ###
+        datasource = self.driver.CreateDataSource(self.path + name)
+        if datasource is None:
+            raise IOError("The file {0} could not be created.".format(self.path + name))
+        
+        layer = None
+        numberOfFeatures = 0
+        
+        try:
+            for chunk in chunks:
+                # geometries and values
+                if isinstance(chunk, tuple):
+                    geometries, values = chunk
+                    geometries = list(geometries)
+                    if values is None:
+                        chunk = pd.DataFrame(index=range(len(geometries)))
+                    else:
+                        # relabel, values may be a slice with a running index
+                        chunk = pd.DataFrame(values).reset_index(drop=True)
+                        if len(chunk) != len(geometries):
+                            raise AttributeError("The chunk has {0} geometries but {1} rows of values.".format(len(geometries), len(chunk)))
+                    chunk['geometry'] = geometries
+                
+                if layer is None:
+                    layer = self._createLayer(datasource, name.split('.')[0], chunk, width, precision, fields_only=True)
+                    columns = [col for col in chunk.columns if col not in ('geometry', 'geom')]
+                
+                if 'geom' in chunk.columns:
+                    geometry = chunk['geom'].tolist()
+                else:
+                    geometry = chunk['geometry'].tolist()
+                
+                values = [self._fieldValues(chunk[col]) for col in columns]
+                numberOfFeatures += self._writeFeatures(layer, geometry, values, max(len(geometry), 1))
+        finally:
+            # close the file
+            datasource.Destroy()
+        
+        return numberOfFeatures
+    
+    
+    def _createLayer(self, datasource, name, DataFrame, width=20, precision=5, batchsize=10000, fields_only=False):
+        """
+        Create the layer name in datasource and write all rows of DataFrame 
+        into it. Formats other than ESRI Shapefile are created with a spatial 
+        index. Returns the number of written features. If fields_only is 
+        True, no features are written and the layer is returned.
+        """
         # check DataFrame class
         if not isinstance(DataFrame, pd.DataFrame):
             raise TypeError("DataFrame has to be an pandas:DataFrame, found {0}".format(DataFrame.__class__))
         
-        if not 'geometry' in DataFrame.columns or 'geom' in DataFrame.columns:
+        if not ('geometry' in DataFrame.columns or 'geom' in DataFrame.columns):
             raise TypeError("The DataFrame needs a column called 'geom' or 'geometry' for storing OGR Geometries")
         
-
-        ### create file ###
-        shpfile = self.driver.CreateDataSource(self.path + name)
-        # create layer use name as layername
-        layer = shpfile.CreateLayer(name.split('.')[0], self.ref)
+        # create layer
+        if self.extension in ('', '.shp'):
+            layer = datasource.CreateLayer(name, self.ref)
+        else:
+            layer = datasource.CreateLayer(name, self.ref, options=['SPATIAL_INDEX=YES'])
         
         ### create a field for each column, which is not a geometry column ###
-        for col in DataFrame.columns:
-            if col not in ('geometry', 'geom'):
-                field = ogr.FieldDefn(col, ogr.OFTReal)
-                # width of
-                field.SetWidth(width)
-                field.SetPrecision(precision)
-                # create
-                layer.CreateField(field)
+        columns = [col for col in DataFrame.columns if col not in ('geometry', 'geom')]
+        values = self._createFields(layer, DataFrame, columns, width, precision)
+        
+        if fields_only:
+            return layer
         
         # get the geometry column
-        try:
-            geometry = DataFrame.geom
-        except:
-            geometry = DataFrame.geometry
+        if 'geom' in DataFrame.columns:
+            geometry = DataFrame['geom'].tolist()
+        else:
+            geometry = DataFrame['geometry'].tolist()
         
         # Create Features
-        for i in range(len(geometry)):
-            # create feature
-            feature = ogr.Feature(layer.GetLayerDefn())
-            # set geometry
-            feature.SetGeometry(geometry[i])
-            
-            # set all values
-            for col in DataFrame.columns:
-                if col not in ('geometry', 'geom'):
-                    feature.SetField(col, float(DataFrame[col][i]))
+        return self._writeFeatures(layer, geometry, values, batchsize)
+    
+    
+    def _createFields(self, layer, DataFrame, columns, width=20, precision=5):
+        """
+        Create a field for each of columns in layer, the OGR field type is 
+        taken from the column dtype. Returns the column values as lists, 
+        converted to the types accepted by the fields.
+        """
+        values = []
+        
+        for col in columns:
+            column = DataFrame[col]
+            kind = column.dtype.kind
             
-            # add feature to layer
-            layer.CreateFeature(feature)
-            feature.Destroy()
+            if kind == 'b':
+                field = ogr.FieldDefn(str(col), ogr.OFTInteger)
+            elif kind in 'iu':
+                # 64 bit integer fields are available since GDAL 2.0
+                if column.dtype.itemsize > 4 and hasattr(ogr, 'OFTInteger64'):
+                    field = ogr.FieldDefn(str(col), ogr.OFTInteger64)
+                else:
+                    field = ogr.FieldDefn(str(col), ogr.OFTInteger)
+            elif kind == 'f':
+                field = ogr.FieldDefn(str(col), ogr.OFTReal)
+                field.SetWidth(width)
+                field.SetPrecision(precision)
+            else:
+                field = ogr.FieldDefn(str(col), ogr.OFTString)
             
-            numberOfFeatures = i
+            layer.CreateField(field)
+            values.append(self._fieldValues(column))
+        
+        return values
+    
+    
+    def _fieldValues(self, column):
+        """
+        Returns the values of column as list of the types accepted by the 
+        field created in _createFields.
+        """
+        kind = column.dtype.kind
+        
+        if kind == 'b':
+            column = column.astype(int)
+        elif kind not in 'iuf':
+            return [v if v is None or isinstance(v, (str, type(u''))) else str(v) for v in column.tolist()]
         
-        # close the Shapefile
-        shpfile.Destroy()
+        return column.tolist()
+    
+    
+    def _writeFeatures(self, layer, geometries, values, batchsize=10000):
+        """
+        Write one feature per geometry with the field values taken from 
+        values, a list of one sequence per field. A single feature object is 
+        reused and the features are committed in transactions of batchsize.
+        Returns the number of written features.
+        """
+        feature = ogr.Feature(layer.GetLayerDefn())
+        fields = list(range(len(values)))
+        n = len(geometries)
+        
+        for start in range(0, n, batchsize):
+            layer.StartTransaction()
+            
+            for i in range(start, min(start + batchsize, n)):
+                # reset the FID, otherwise the feature would be overwritten
+                feature.SetFID(ogr.NullFID)
+                feature.SetGeometry(geometries[i])
+                
+                for k in fields:
+                    value = values[k][i]
+                    if value is None:
+                        feature.UnsetField(k)
+                    else:
+                        feature.SetField(k, value)
+                
+                if layer.CreateFeature(feature) != 0:
+                    layer.RollbackTransaction()
+                    raise IOError("Feature {0} could not be written to layer '{1}'".format(i, layer.GetName()))
+            
+            layer.CommitTransaction()
         
-        return numberOfFeatures
\ No newline at end of file
+        return n
@@ -2,11 +2,16 @@
 """
 """
 import pandas as pd
+import numpy as np
 import os
 from locomotif.spatial.Cluster import Cluster
 from osgeo import osr
 
-def read_csv(path, column_mapping=None, parse_ogr=True, **kwds):
+# Cluster archive written by saveCluster: magic string and block alignment
+_MAGIC = b'LOCOMOTF'
+_ALIGN = 64
+
+def read_csv(path, column_mapping=None, parse_ogr=True, min_sat=None, max_hdop=None, bbox=None, **kwds):
     """
     Function wrapper for pandas.read_csv. path and kwds are passed to read_csv 
     and the resulting DataFrame will be returned. 
@@ -20,64 +25,225 @@ def read_csv(path, column_mapping=None, parse_ogr=True, **kwds):
     If parse_ogr is True, the lon and lat column will be replaced by a geom 
     column containing the OGR Geometry representing a point. This is needed in 
     case the df will be used as Cluster in an locomotif.Grid object.
+    If parse_ogr is False, lon and lat are kept as float64 columns and no OGR 
+    Geometry is created at all. Use this for large files, a locomotif.Cluster 
+    can directly be created from the lon and lat columns.
+    Poor GPS fixes can be dropped before any Geometry is build. min_sat is the 
+    minimum number of satellites in the 'SAT' column, max_hdop the maximum 
+    value of the 'HDOP' column and bbox a list of [minX, maxX, minY, maxY] 
+    all lon, lat pairs have to be within.
     """    
-
     # check if a predefined mapsta version was given
     # this would replace all other kwds
-    try:
-        if kwds['mapsta_version'].__class__ == int:
-            # a mapsta version number is given, overwrite kwds
-            from locomotif.settings.mapsta import get_csv_options
-            kwds = get_csv_options(kwds['mapsta_version'])
-            
-        # delete mapsta_versions before passing it to pd.read_csv
-        del kwds['mapsta_version']
-    except KeyError:
-        # kwds['mapsta_version was not set']
-        pass
+    kwds = _csv_options(kwds)
     
     # read the csv file at path
     df = pd.read_csv(path, **kwds)            
     
+    return _parse_points(df, column_mapping, parse_ogr, min_sat, max_hdop, bbox)
+
+
+def read_csv_chunks(path, chunksize=100000, column_mapping=None, parse_ogr=True, min_sat=None, max_hdop=None, bbox=None, **kwds):
+    """
+    Generator version of read_csv for files larger than memory. The file at 
+    path is read by pandas.read_csv in chunks of chunksize rows and each chunk 
+    is yielded as DataFrame, parsed exactly like read_csv would do it. Thus, 
+    each chunk can directly be used to create a locomotif.Cluster and the 
+    first chunk can be processed while the rest of the file is still unread.
+    column_mapping, parse_ogr, the quality filters min_sat, max_hdop and bbox, 
+    mapsta_version and all other kwds are handled like in read_csv.
+    """
+    if not isinstance(chunksize, int) or chunksize < 1:
+        raise AttributeError("chunksize has to be a positive integer, found {0}.".format(chunksize))
+    
+    kwds = _csv_options(kwds)
+    kwds['chunksize'] = chunksize
+    
+    # the reader only holds one chunk at a time
+    for df in pd.read_csv(path, **kwds):
+        yield _parse_points(df, column_mapping, parse_ogr, min_sat, max_hdop, bbox)
+
+
+def read_csv_files(paths, processes=None, source_column='source', column_mapping=None, SpatialReference=None, **kwds):
+    """
+    Reads many csv-like files into a single locomotif.Cluster. paths can be a 
+    glob pattern like 'sample_data/*.txt' or a list of file paths. The files 
+    are parsed on a pool of processes worker processes, if None, one per CPU 
+    is used. processes=1 reads all files in this process.
+    The file name of each row is stored in the source_column, which becomes a 
+    dataset of the Cluster. Set source_column to None to omit it.
+    column_mapping, the quality filters, mapsta_version and all other kwds 
+    are passed to read_csv for each file. No OGR Geometry is build, the 
+    Cluster takes the merged lon and lat columns as they are.
+    """
+    import glob
+    from multiprocessing import Pool
+    
+    # get the file list
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(paths))
+    if len(paths) == 0:
+        raise AttributeError("No files to read were found.")
+    
+    jobs = [(path, source_column, column_mapping, kwds) for path in paths]
+    
+    # parse the files
+    if processes == 1 or len(jobs) == 1:
+        frames = [_read_file(job) for job in jobs]
+    else:
+        pool = Pool(processes)
+        try:
+            frames = pool.map(_read_file, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    
+    # merge all files
+    df = pd.concat(frames, ignore_index=True)
+    
+    return Cluster(df, SpatialReference=SpatialReference)
+
+
+def _read_file(job):
+    """
+    Worker function of read_csv_files. job is a tuple of path, source_column, 
+    column_mapping and the read_csv keywords. Returns the DataFrame with float 
+    lon and lat columns.
+    """
+    path, source_column, column_mapping, kwds = job
+    
+    df = read_csv(path, column_mapping=column_mapping, parse_ogr=False, **kwds)
+    
+    if not 'lon' in df.columns or not 'lat' in df.columns:
+        raise KeyError("The file {0} does not contain a lon and a lat column.".format(path))
+    
+    if source_column is not None:
+        df[source_column] = os.path.basename(path)
+    
+    return df
+
+
+def follow_csv(path, Cluster=None, offset=0, column_mapping=None, SpatialReference=None, min_sat=None, max_hdop=None, bbox=None, **kwds):
+    """
+    Incremental read_csv for growing tracker files. Only the complete rows 
+    behind the byte offset are parsed and appended to Cluster. If Cluster is 
+    None, a new locomotif.Cluster is created from the new rows. Returns the 
+    Cluster and the new offset, which has to be passed on the next call:
+    
+        cluster, offset = follow_csv(path)
+        # ... later on
+        cluster, offset = follow_csv(path, cluster, offset)
+    
+    A row not yet terminated by a newline is left for the next call. If there 
+    are no rows yet, Cluster is returned unchanged (None on the first call).
+    column_mapping, the quality filters min_sat, max_hdop and bbox, 
+    mapsta_version and all other kwds are handled like in read_csv.
+    """
+    from io import BytesIO
+    
+    kwds = _csv_options(kwds)
+    
+    if os.path.getsize(path) < offset:
+        raise IOError("The file {0} is smaller than offset {1}, it was truncated or replaced.".format(path, offset))
+    
+    # read all bytes behind offset
+    with open(path, 'rb') as fs:
+        fs.seek(offset)
+        data = fs.read()
+    
+    # only complete rows are parsed
+    end = data.rfind(b'\n') + 1
+    if end == 0:
+        return Cluster, offset
+    
+    if offset > 0:
+        # the header is not part of data, pass the column names instead
+        if not 'names' in kwds:
+            header = {key:kwds[key] for key in ('sep', 'delimiter', 'encoding') if key in kwds}
+            kwds['names'] = list(pd.read_csv(path, nrows=0, **header).columns)
+        kwds['header'] = None
+        kwds.pop('skiprows', None)
+    
+    df = pd.read_csv(BytesIO(data[:end]), **kwds)
+    df = _parse_points(df, column_mapping, False, min_sat, max_hdop, bbox)
+    
+    if len(df) > 0:
+        if Cluster is None:
+            from locomotif.spatial.Cluster import Cluster as _Cluster
+            Cluster = _Cluster(df, SpatialReference=SpatialReference)
+        else:
+            Cluster.append(df)
+    
+    return Cluster, offset + end
+
+
+def _csv_options(kwds):
+    """
+    Returns the keywords for pandas.read_csv. If mapsta_version is given as 
+    integer, all other keywords are replaced by the options found in the 
+    locomotif.settings.mapsta module. mapsta_version is never passed on.
+    """
+    kwds = dict(kwds)
+    version = kwds.pop('mapsta_version', None)
+    
+    if version.__class__ == int:
+        # a mapsta version number is given, overwrite kwds
+        from locomotif.settings.mapsta import get_csv_options
+        kwds = get_csv_options(version)
+    
+    return kwds
+
+
+def _parse_points(df, column_mapping=None, parse_ogr=True, min_sat=None, max_hdop=None, bbox=None):
+    """
+    Renames the columns of df by column_mapping, drops all rows failing the 
+    quality filters and either replaces the lon and lat column by a geom 
+    column of OGR POINT Geometries (parse_ogr=True) or keeps them as float64 
+    columns.
+    The coordinates are taken as one numpy array, there is no WKT round-trip.
+    """
     # in case lon and lat are not specified so far, column_mapping 
     # shall be used for renaming the columns
     if column_mapping is not None:
-        df.rename(column_mapping)
-        try:
-            df[['lon', 'lat']]
-        except KeyError:
+        df = df.rename(columns=column_mapping)
+    
+    if not 'lon' in df.columns or not 'lat' in df.columns:
+        if column_mapping is not None or parse_ogr:
             raise KeyError('The files has to contain a lon and a lat coulmn, or they have to be mapped using column_mapping keword.')
+        return _filter_fixes(df, min_sat, max_hdop, bbox)
+    
+    # drop the poor fixes before the Geometries are build
+    df = _filter_fixes(df, min_sat, max_hdop, bbox)
+    
+    # extract coordinates as float64 numpy array
+    coordinates = df[['lon', 'lat']].values.astype(np.float64)
     
     if parse_ogr:
-        # TODO: this will be converted into an parsing function
-
-        # extract coordinates as numpy array and convert to wkt string
-        wkt = ["POINT ({0} {1})".format(x,y) for x,y in df[['lon', 'lat']].values]
+        from locomotif.spatial.spatial import ArrayToPoint
         
         # copy df without lon and lat column
-        df1 = df.drop('lon', 1).drop('lat', 1)
-        
-        # import ogr
-        from osgeo import ogr
+        df = df.drop(['lon', 'lat'], axis=1)
         
-        # convert wkt to OGR.Geometry
-        geom = [ogr.CreateGeometryFromWkt(string) for string in wkt]
-        
-        # set as column in df1
-        df1['geom'] = geom
-        
-        # return
-        return df1
+        # build all OGR Geometries at once
+        df['geom'] = ArrayToPoint(coordinates)
     else:
-        return df
-    
+        df['lon'] = coordinates[:, 0]
+        df['lat'] = coordinates[:, 1]
+        
+    return df
     
 
 def read_Cluster(path):
     """
-    The given path has to be a folder containing the ref file as XML or TXT and 
-    one or more .pickle files containing the cluster DataFrames
+    The given path has to be a Cluster archive written by saveCluster, or a 
+    folder containing the ref file as XML or TXT and one or more .pickle 
+    files containing the cluster DataFrames.
+    The coordinates and numeric datasets of an archive are memory-mapped 
+    read-only, thus only the touched parts are read from disk.
     """
+    if os.path.isfile(path):
+        return _read_archive(path)
+    
     if not os.path.exists(path) or not os.path.isdir(path):
         raise TypeError("The given path ({0}) does not point to a valid folder".format(path))
     
@@ -107,3 +273,99 @@ def read_Cluster(path):
     c.setDebug(False)
     
     return c
+
+
+def _read_archive(path):
+    """
+    Returns the Cluster stored in the archive at path, see saveCluster.
+    """
+    import json, struct, pickle
+    from osgeo import ogr
+    
+    with open(path, 'rb') as fs:
+        if fs.read(len(_MAGIC)) != _MAGIC:
+            raise TypeError("The given path ({0}) does not point to a valid Cluster archive".format(path))
+        length = struct.unpack('<Q', fs.read(8))[0]
+        header = json.loads(fs.read(length).decode('utf-8'))
+        
+        # data blocks are positioned relative to the aligned data start
+        begin = -(-(len(_MAGIC) + 8 + length) // _ALIGN) * _ALIGN
+        
+        # pickled datasets are read at once
+        objects = dict()
+        for name, block in header['objects'].items():
+            fs.seek(begin + block['offset'])
+            objects[name] = (block['kind'], pickle.loads(fs.read(block['length'])))
+    
+    def mmap(block):
+        # numpy cannot map empty arrays
+        if int(np.prod(block['shape'])) == 0:
+            return np.empty(block['shape'], dtype=block['dtype'])
+        return np.memmap(path, dtype=block['dtype'], mode='r', offset=begin + block['offset'], shape=tuple(block['shape']))
+    
+    ref = osr.SpatialReference()
+    if 'xml' in header:
+        ref.ImportFromXML(str(header['xml']))
+    else:
+        ref.ImportFromWkt(str(header['wkt']))
+    
+    # create a Cluster in debug mode
+    c = Cluster(SpatialReference=ref, debug=True)
+    
+    coordinates = mmap(header['coordinates']) if header['coordinates'] is not None else None
+    values = dict((name, mmap(block)) for name, block in header['values'].items())
+    
+    for name in header['datasets']:
+        if name in values:
+            continue
+        kind, data = objects[name]
+        if kind == 'frame':
+            # restore the OGR geometries
+            if 'geometry' in data.columns:
+                data['geometry'] = [None if wkb is None else ogr.CreateGeometryFromWkb(wkb) for wkb in data.geometry]
+            c._setDataset(data, name)
+        else:
+            values[name] = data
+    
+    c._setColumns(coordinates, values, [name for name in header['datasets'] if name in values])
+    
+    # same order as saved
+    c.datasets = list(header['datasets'])
+    
+    # disable debug mode
+    c.setDebug(False)
+    
+    return c
+
+
+def _filter_fixes(df, min_sat=None, max_hdop=None, bbox=None):
+    """
+    Returns df without the rows having less than min_sat satellites in the 
+    'SAT' column, a 'HDOP' larger than max_hdop or lon, lat out of 
+    bbox = [minX, maxX, minY, maxY]. The filters are applied on the raw numpy 
+    columns, None disables a filter. The index of the result is reset.
+    """
+    if min_sat is None and max_hdop is None and bbox is None:
+        return df
+    
+    mask = np.ones(len(df), dtype=bool)
+    
+    try:
+        if min_sat is not None:
+            mask &= df['SAT'].values >= min_sat
+        if max_hdop is not None:
+            mask &= df['HDOP'].values <= max_hdop
+    except KeyError as e:
+        raise KeyError("The quality filter needs a {0} column.".format(e))
+    
+    if bbox is not None:
+        if len(bbox) != 4:
+            raise TypeError("bbox has to be given as [minX, maxX, minY, maxY]")
+        lon = df['lon'].values
+        lat = df['lat'].values
+        mask &= (lon >= bbox[0]) & (lon <= bbox[1]) & (lat >= bbox[2]) & (lat <= bbox[3])
+    
+    if mask.all():
+        return df
+    
+    return df[mask].reset_index(drop=True)
@@ -14,9 +14,9 @@ from spatial import Cluster
 from mapper import Mapper
 
 
-from IOstream.ImportStream import read_csv, read_Cluster
+from IOstream.ImportStream import read_csv, read_csv_chunks, read_csv_files, follow_csv, read_Cluster
 
-from IOstream.ExportStream import saveCluster, exportShp
+from IOstream.ExportStream import saveCluster, exportShp, exportGpkg, exportFgb, exportChunks
 
 
 
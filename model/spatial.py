@@ -7,80 +7,348 @@ Created on Wed Jun 17 13:06:10 2015
 
 def polygon_intersect(clusters, only_polygon=True, no_lines=True, **kwargs):
     """
-    Takes exactly two pandas.DataFrames containing a 'geometry' and 'value' 
+    Takes two or more pandas.DataFrames containing a 'geometry' and 'value' 
     column. The polygons will be intersected and filled with the mean value
-    of the two value fields. other aggregation can be passed.
+    of the value fields. other aggregation can be passed.
     Result is returned as pandas.DataFrame.
     
     geometry has to contain OGR Polygon geometries
     value has to be of type int, float (or numpy ints, floats)
     
     **kwargs: func=np.XX pass function for intersection to be used over np.mean.
+              weights='area' or a list of layer weights, target, see overlay.
+              tiles=n or (nx, ny) and processes for a parallel, tiled 
+              overlay, see overlay.
     """
-    import pandas as pd
-    
     if not isinstance(clusters, list):
         raise AttributeError('The input clusters have to be given as a list of DataFrames')
     
-    #### DEVELOPMENT
-    if not len(clusters) == 2:
-        raise AttributeError('For now, only exactly two cluster layers can be processed, you passed {0}.'.format(len(clusters)))
+    if len(clusters) < 2:
+        raise AttributeError('At least two cluster layers are needed, you passed {0}.'.format(len(clusters)))
     
-    if not all([isinstance(cluster, pd.DataFrame) for cluster in clusters]):
-        raise AttributeError('clusters has to contain exactly 2 pandas.DataFrames.\nFound other types.')
+    unknown = set(kwargs) - set(('func', 'weights', 'tiles', 'processes', 'target'))
+    if len(unknown) > 0:
+        raise AttributeError('Unknown keyword arguments: {0}.'.format(', '.join(sorted(unknown))))
     
-    # get the input data
-    x = clusters[0]
-    y = clusters[1]
+    return overlay(clusters, func=kwargs.get('func'), weights=kwargs.get('weights'), only_polygon=only_polygon, no_lines=no_lines, tiles=kwargs.get('tiles'), processes=kwargs.get('processes'), target=kwargs.get('target', 0))
+
+
+def overlay(clusters, func=None, weights=None, only_polygon=True, no_lines=True, tiles=None, processes=None, target=0):
+    """
+    Intersects any number of pandas.DataFrames containing a 'geometry' and 
+    'value' column. Each resulting polygon is covered by exactly one feature 
+    of each layer, their values are aggregated once for all layers:
+    
+        weights=None        func(values, axis=1), func defaults to np.mean
+        weights=[w1, ...]   weighted mean using one weight per layer
+        weights='area'      area weighted mean onto the features of the 
+                            layer target: the other layers are aggregated 
+                            by func for each polygon, then all polygons of a 
+                            target feature are averaged weighted by their 
+                            area. The result has one row per target feature, 
+                            NaN if it is not covered by the other layers.
+    
+    If only_polygon is True, only POLYGON intersections are kept, if no_lines 
+    is True, point and line intersections are dropped.
+    For large layers, tiles=n or (nx, ny) partitions the extent into spatial 
+    tiles, which are intersected on a pool of processes worker processes 
+    (one per CPU if None). Each polygon is kept by exactly one tile.
+    Result is returned as pandas.DataFrame of 'geometry' and 'value'.
+    """
+    import numpy as np
+    import pandas as pd
+    
+    if not isinstance(clusters, list) or not all([isinstance(cluster, pd.DataFrame) for cluster in clusters]):
+        raise AttributeError('clusters has to be a list of pandas.DataFrames.')
+    
+    if len(clusters) == 0:
+        raise AttributeError('At least one cluster layer is needed.')
     
     # ceck for the columns
-    if not 'geometry' in x.columns and not 'value' in x.columns:
-        raise AttributeError("The first cluster does not have a 'geometry' and 'value' column.")
-
-    if not 'geometry' in y.columns and not 'value' in y.columns:
-        raise AttributeError("The first cluster does not have a 'geometry' and 'value' column.")
+    for n, cluster in enumerate(clusters):
+        if not 'geometry' in cluster.columns or not 'value' in cluster.columns:
+            raise AttributeError("The cluster {0} does not have a 'geometry' and 'value' column.".format(n))
     
-    # check kwargs for other function
-    if 'func' in kwargs:
-        func = kwargs['func']
-    else:
-        import numpy as np
+    if func is None:
         func = np.mean      # default function
     
-    ### now the data should be fine 
-    ### intersect any feature of x with any feature of y
-    ### the value will be the mean
-    geometries = []
-    values = []
+    ### intersect all layers ###
+    layers = [list(cluster.geometry) for cluster in clusters]
+    if tiles is None:
+        geometries, sources = _overlay(layers, only_polygon, no_lines)
+    else:
+        geometries, sources = _tiled_overlay(layers, tiles, processes, only_polygon, no_lines)
+    
+    # one column of source values per layer
+    values = np.column_stack([np.asarray(cluster.value, dtype=np.float64)[sources[:, n]] for n, cluster in enumerate(clusters)])
     
-    for i, item in x.iterrows():
-        # get the geometry of x
-        x_geom = item.geometry
-        val = item.value
+    ### aggregate ###
+    if weights is None:
+        value = _aggregate(values, func)
+    elif isinstance(weights, str):
+        if weights != 'area':
+            raise AttributeError("weights has to be None, 'area' or a list of layer weights, found {0}.".format(weights))
         
-        for j, jtem in y.iterrows():
-            # go for all y features
-            # check for intersection
-            if not x_geom.Intersects(jtem.geometry):
-                continue
-            intersect = x_geom.Intersection(jtem.geometry)
-            
-            if only_polygon:
-                if not intersect.GetGeometryType() == 3:
-                    # its not a polygon
-                    continue
-            
-            if no_lines:
-                if intersect.GetGeometryType() < 3:
-                    # no points, no lines
-                    continue
-            
-            geometries.append(x_geom.Intersection(jtem.geometry))
-            values.append(func([val, jtem.value]))
+        return _area_weighted(layers, geometries, sources, values, func, target)
+    else:
+        if len(weights) != len(clusters):
+            raise AttributeError("Give one weight per cluster layer, found {0} weights for {1} layers.".format(len(weights), len(clusters)))
+        w = np.broadcast_to(np.asarray(weights, dtype=np.float64), values.shape)
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            value = np.sum(w * values, axis=1) / np.sum(w, axis=1)
     
     # create a DataFrame and return
-    return pd.DataFrame({'geometry':geometries, 'value':values})
+    return pd.DataFrame({'geometry':geometries, 'value':value})
+
+
+def _area_weighted(layers, geometries, sources, values, func, target=0):
+    """
+    Aggregates the overlay polygons onto the features of layer target. The 
+    values of all other layers are aggregated by func per polygon, then 
+    sum(area * value) / sum(area) is computed over the polygons of each 
+    target feature. Returns a pandas.DataFrame of the target geometries and 
+    the weighted values.
+    """
+    import numpy as np
+    import pandas as pd
+    
+    if not 0 <= target < len(layers):
+        raise AttributeError("target has to be the index of a cluster layer, found {0}.".format(target))
+    
+    others = [n for n in range(len(layers)) if n != target]
+    if len(others) == 0:
+        raise AttributeError("Area weighting needs at least two cluster layers.")
+    
+    value = _aggregate(values[:, others], func)
+    areas = np.array([geometry.GetArea() for geometry in geometries], dtype=np.float64)
+    
+    # sum up per target feature
+    valid = np.isfinite(value)
+    group = sources[valid, target]
+    n = len(layers[target])
+    total = np.bincount(group, weights=areas[valid], minlength=n)
+    weighted = np.bincount(group, weights=areas[valid] * value[valid], minlength=n)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weighted = weighted / total
+    weighted[total == 0] = np.nan
+    
+    return pd.DataFrame({'geometry':layers[target], 'value':weighted})
+
+
+def _overlay(layers, only_polygon=True, no_lines=True):
+    """
+    Intersects all layers, given as lists of OGR Geometries. Candidates are 
+    searched by their envelopes, each intersection is computed once. 
+    Returns the list of resulting Geometries and a (n, layers) numpy.ndarray 
+    holding the index of the source feature in each layer.
+    """
+    import numpy as np
+    
+    geometries = list(layers[0])
+    sources = np.arange(len(geometries))[:, np.newaxis]
+    
+    for layer in layers[1:]:
+        x_idx, y_idx = _candidate_pairs(_envelopes(geometries), _envelopes(layer))
+        
+        intersections = []
+        found = []
+        for k, (i, j) in enumerate(zip(x_idx.tolist(), y_idx.tolist())):
+            intersect = geometries[i].Intersection(layer[j])
+            if _keep(intersect, only_polygon, no_lines):
+                intersections.append(intersect)
+                found.append(k)
+        
+        found = np.asarray(found, dtype=np.intp)
+        sources = np.column_stack((sources[x_idx[found]], y_idx[found]))
+        geometries = intersections
+    
+    return geometries, sources
+
+
+def _tiled_overlay(layers, tiles, processes=None, only_polygon=True, no_lines=True):
+    """
+    Same as _overlay, but the extent is split into tiles=n or (nx, ny) tiles 
+    processed in parallel. Each tile gets all features with an envelope 
+    overlapping the tile. A result is kept only by the tile containing the 
+    lower left corner of the common envelope of its source features, thus 
+    features crossing tile borders are not duplicated.
+    """
+    import numpy as np
+    from multiprocessing import Pool
+    from osgeo import ogr
+    
+    if not hasattr(tiles, '__len__'):
+        tiles = (tiles, tiles)
+    
+    envelopes = [_envelopes(layer) for layer in layers]
+    extent = np.vstack(envelopes)
+    
+    # tile borders, the outer tiles are open
+    xs = np.linspace(extent[:, 0].min(), extent[:, 1].max(), tiles[0] + 1)
+    ys = np.linspace(extent[:, 2].min(), extent[:, 3].max(), tiles[1] + 1)
+    xs[0], xs[-1], ys[0], ys[-1] = -np.inf, np.inf, -np.inf, np.inf
+    
+    ### create one job per tile ###
+    jobs = []
+    for tx in range(tiles[0]):
+        for ty in range(tiles[1]):
+            bounds = (xs[tx], xs[tx + 1], ys[ty], ys[ty + 1])
+            members = [np.flatnonzero((e[:, 1] >= bounds[0]) & (e[:, 0] <= bounds[1]) & (e[:, 3] >= bounds[2]) & (e[:, 2] <= bounds[3])) for e in envelopes]
             
+            if any(len(idx) == 0 for idx in members):
+                continue
+            
+            wkb = [[layer[k].ExportToWkb() for k in idx.tolist()] for layer, idx in zip(layers, members)]
+            jobs.append((bounds, wkb, members, [e[idx] for e, idx in zip(envelopes, members)], only_polygon, no_lines))
+    
+    ### process the tiles ###
+    if processes == 1 or len(jobs) < 2:
+        results = [_overlay_tile(job) for job in jobs]
+    else:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_overlay_tile, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    
+    ### stitch ###
+    wkb = [w for result in results for w in result[0]]
+    sources = np.vstack([result[1] for result in results] + [np.empty((0, len(layers)), dtype=np.intp)])
+    
+    # same order as without tiles
+    order = np.lexsort(sources.T[::-1])
+    
+    return [ogr.CreateGeometryFromWkb(wkb[k]) for k in order.tolist()], sources[order]
+
+
+def _overlay_tile(job):
+    """
+    Worker function of _tiled_overlay. job is a tuple of the tile bounds, 
+    the WKB, global indices and envelopes of the features per layer and 
+    the filter flags. Returns the WKB and global source indices of all 
+    results owned by this tile.
+    """
+    import numpy as np
+    from osgeo import ogr
+    
+    bounds, wkb, members, envelopes, only_polygon, no_lines = job
+    
+    layers = [[ogr.CreateGeometryFromWkb(w) for w in layer] for layer in wkb]
+    geometries, sources = _overlay(layers, only_polygon, no_lines)
+    
+    # lower left corner of the common envelope
+    x = np.max(np.column_stack([e[sources[:, n], 0] for n, e in enumerate(envelopes)]), axis=1)
+    y = np.max(np.column_stack([e[sources[:, n], 2] for n, e in enumerate(envelopes)]), axis=1)
+    own = (x >= bounds[0]) & (x < bounds[1]) & (y >= bounds[2]) & (y < bounds[3])
+    
+    sources = np.column_stack([idx[sources[own, n]] for n, idx in enumerate(members)]).reshape(-1, len(members))
+    
+    return [geometry.ExportToWkb() for geometry, keep in zip(geometries, own.tolist()) if keep], sources
+
+
+def _keep(intersect, only_polygon=True, no_lines=True):
+    """
+    Checks if the intersection Geometry is part of the result.
+    """
+    if intersect is None or intersect.IsEmpty():
+        return False
+    
+    if only_polygon:
+        if not intersect.GetGeometryType() == 3:
+            # its not a polygon
+            return False
+    
+    if no_lines:
+        if intersect.GetGeometryType() < 3:
+            # no points, no lines
+            return False
+    
+    return True
+
+
+def _envelopes(geometries):
+    """
+    Returns the envelopes of all OGR Geometries as (n, 4) numpy.ndarray of 
+    [minX, maxX, minY, maxY].
+    """
+    import numpy as np
+    
+    return np.array([geometry.GetEnvelope() for geometry in geometries], dtype=np.float64).reshape(-1, 4)
+
+
+def _candidate_pairs(a, b, blocksize=10000):
+    """
+    Returns the indices of all pairs of overlapping envelopes of a and b, 
+    given as (n, 4) and (m, 4) numpy.ndarrays of [minX, maxX, minY, maxY]. 
+    The envelopes of b are sorted by minX once, for each envelope of a only 
+    the window of b starting within [minX - widest b, maxX] is checked. 
+    The pairs are returned ordered by the index of a, then b.
+    """
+    import numpy as np
+    
+    if len(a) == 0 or len(b) == 0:
+        return np.array([], dtype=np.intp), np.array([], dtype=np.intp)
+    
+    order = np.argsort(b[:, 0], kind='mergesort')
+    b_min = b[order, 0]
+    width = np.max(b[:, 1] - b[:, 0])
+    
+    pairs_a = []
+    pairs_b = []
+    for start in range(0, len(a), blocksize):
+        block = a[start:start + blocksize]
+        
+        # window of possible partners in sorted b
+        lo = np.searchsorted(b_min, block[:, 0] - width, side='left')
+        hi = np.searchsorted(b_min, block[:, 1], side='right')
+        counts = hi - lo
+        
+        i = np.repeat(np.arange(start, start + len(block)), counts)
+        offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+        j = order[np.repeat(lo, counts) + offsets]
+        
+        # check the full envelopes
+        overlap = (b[j, 1] >= a[i, 0]) & (b[j, 0] <= a[i, 1]) & (b[j, 3] >= a[i, 2]) & (b[j, 2] <= a[i, 3])
+        i = i[overlap]
+        j = j[overlap]
         
+        sort = np.lexsort((j, i))
+        pairs_a.append(i[sort])
+        pairs_b.append(j[sort])
+    
+    return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+
+def _aggregate(values, func):
+    """
+    Applies func on each row of the (n, k) values. Functions having an axis 
+    argument, like np.mean, are called once with axis=1, all others are 
+    called row by row on lists.
+    """
+    import numpy as np
+    
+    if len(values) == 0:
+        return np.array([], dtype=np.float64)
+    
+    if _takes_axis(func):
+        return np.asarray(func(values, axis=1))
+    else:
+        return np.array([func(list(row)) for row in values])
+
+
+def _takes_axis(func):
+    """
+    Returns True if func has an explicit axis argument. Callables without an 
+    inspectable signature (builtins, ufuncs) return False.
+    """
+    import inspect
     
-    
\ No newline at end of file
+    try:
+        if hasattr(inspect, 'signature'):
+            return 'axis' in inspect.signature(func).parameters
+        return 'axis' in inspect.getargspec(func).args
+    except (TypeError, ValueError):
+        return False
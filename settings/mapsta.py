@@ -9,7 +9,36 @@ into LOCOMOTIF application (<http://locomotif.openhydro.org>).
 __version__ = '0.1'
 __author__ = 'Mirko Maelicke'
 
-import json, bisect, os, sys
+import json, bisect, os, copy, threading
+
+# loaded settings files, module name -> (sorted versions, options)
+_SETTINGS = {}
+_SETTINGS_LOCK = threading.Lock()
+
+
+def _load_settings(module):
+    """
+    Returns the sorted version numbers and the options of module. The json 
+    file is read only once per module and then kept in memory. The file is 
+    located by its absolute path, the working directory is not changed.
+    """
+    try:
+        return _SETTINGS[module]
+    except KeyError:
+        pass
+    
+    with _SETTINGS_LOCK:
+        # another thread might have loaded it in the meanwhile
+        if module not in _SETTINGS:
+            filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), '%s_settings.json' % module)
+            with open(filename, 'r') as fs:
+                options = json.loads(fs.read())
+            
+            # index the version numbers once
+            versions = sorted(int(x) for x in options.keys())
+            _SETTINGS[module] = (versions, {int(x):options[x] for x in options})
+    
+    return _SETTINGS[module]
 
 
 def get_csv_options(version=100, module='mapsta'):
@@ -22,31 +51,19 @@ def get_csv_options(version=100, module='mapsta'):
     version or next smaller version. The saved parameters for this version is 
     returned as dictionary. The version number shall be given as at least 3-digit 
     integer, with major-minor-micro, eg.: 105 for 1.0.5 or 2400 for 24.0.0.
+    The settings file is only read on the first call, the function is thread 
+    safe and does not change the working directory.
     """
     
     # check version type
     if version.__class__ != int:
         raise TypeError('version number has to be given as at least 3-digit integer, got %s.' % version.__class__)
-        
-    # get old working directory
-    old_path = os.getcwd()
-    
-    # change path to file location
-    os.chdir(os.path.dirname(__file__))
-#    os.chdir(os.path.dirname(os.path.realpath(sys.argv[0])))
-    
-    options = json.loads(open('%s_settings.json' % module, 'r').read())
-    
-    # set old path again
-    os.chdir(old_path)
     
-    # get the version numbers
-    versions = [int(x) for x in options.keys()]
-    versions.sort()
+    versions, options = _load_settings(module)
     
     # get latest version parameters
-    params = options['%d' % (versions[bisect.bisect(versions, version) - 1])]
+    params = options[versions[bisect.bisect(versions, version) - 1]]
     
-    # return as dict or keywords
-    return params
+    # return a copy, the caller may change the dict
+    return copy.deepcopy(params)
     
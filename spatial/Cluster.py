@@ -7,21 +7,29 @@ Created on Tue Mar 24 12:48:16 2015
 
 import pandas as pd
 import numpy as np
-from scipy.spatial import Delaunay
+from scipy.spatial import Delaunay, cKDTree
 from osgeo import ogr, osr
 import spatial, voronoi
 
+# aggregation functions for triangle values, called with axis=1
+_AGGREGATIONS = {'mean':np.mean, 'median':np.median, 'min':np.min, 'max':np.max}
+
 class Cluster(object):
     """
     The locomotif Cluster objects manages all imported (GPS) data and 
     offers interpolation and modelling functions. Results can be exported from
     this object.
+    The point coordinates are stored once as (n, 2) numpy.ndarray shared by 
+    all datasets, each dataset is a numpy.ndarray of n values. OGR Geometries 
+    are only build when a dataset is requested as DataFrame.
     """
     def __init__(self, DataFrame=None, SpatialReference=None, geometry_column=None, debug=False):
         """
         DataFrame is a pandas.DataFrame including a column of OGR POINT geometries.
         This column can be identified by geometry_column, if None, the first 
         occurance of a column containg only OGR POINT Geometry objects will be used.
+        If there is no such column, a 'lon' and 'lat' column of coordinates 
+        will be used, as returned by read_csv with parse_ogr=False.
         SpatialReference has to be of Type osr.SpatialReference giving the correct 
         reference for the geometries. If None given, WGS84 (EPSG:4326) is assumed.
         This only works if GDAL_PATH is set in environment.
@@ -43,6 +51,16 @@ class Cluster(object):
         # create a list of all datasets
         self.datasets = []
         
+        # shared point coordinates and one value array per dataset
+        self.coordinates = None
+        self._values = dict()
+        
+        # DataFrames set directly in debug mode
+        self._frames = dict()
+        
+        # triangulations and KD-trees per point set, None for the shared coordinates
+        self._indices = dict()
+        
         ### DataFrame has to contain a column of OGR Point Geometries ###
         if isinstance(DataFrame, pd.DataFrame):
             ### no geometry_column ==> search it ### 
@@ -50,11 +68,12 @@ class Cluster(object):
                 # parse the geometry column
                 for column in DataFrame:
                     # check all items
-                    if all([isinstance(item, ogr.Geometry) for item in DataFrame[column]]):
+                    if DataFrame[column].dtype == object and all(isinstance(item, ogr.Geometry) for item in DataFrame[column]):
                         geometry_column = str(column)
+                        break
                     
                 # number of found geometry columns
-                if geometry_column is None:
+                if geometry_column is None and not ('lon' in DataFrame.columns and 'lat' in DataFrame.columns):
                     raise AttributeError("No geometry_column could be found. use geometry_column to pass column name.")
                     
             ### found geometry_column ###        
@@ -64,19 +83,26 @@ class Cluster(object):
             else:
                 raise TypeError("geometry_column as to be a str or NoneType, found {0}".format(geometry_column.__class__))
             
-            ### check all geometries to be points ###
-            if not all([item.GetGeometryName() == 'POINT' for item in DataFrame[geometry_column]]):
-                raise TypeError("The column {0} contains other Geometries than 'POINT'.".format(geometry_column))
+            ### extract the coordinates once ###
+            if geometry_column is not None:
+                # check all geometries to be points
+                if not all(item.GetGeometryName() == 'POINT' for item in DataFrame[geometry_column]):
+                    raise TypeError("The column {0} contains other Geometries than 'POINT'.".format(geometry_column))
+                
+                self.coordinates = np.array([item.GetPoint_2D() for item in DataFrame[geometry_column]], dtype=np.float64).reshape(-1, 2)
+                coordinate_columns = [geometry_column]
+            else:
+                self.coordinates = DataFrame[['lon', 'lat']].values.astype(np.float64)
+                coordinate_columns = ['lon', 'lat']
             
             ### append all value columns ###
-            # this should identy the geometry column
             for column in DataFrame:
                 # if geometry column ==> continue
-                if column == geometry_column:
+                if column in coordinate_columns:
                     continue
                 else:
-                    # set  a DataFrame for each found value column
-                    setattr(self, column, pd.DataFrame({'geometry':DataFrame[geometry_column], 'value':DataFrame[column]}))
+                    # set an array for each found value column
+                    self._values[column] = DataFrame[column].values
                     
                     # append name to dataset
                     self.datasets.append(column)
@@ -92,6 +118,17 @@ class Cluster(object):
             self.debug = False
     
     
+    def __getattr__(self, name):
+        """
+        Datasets are still available as attributes, self.name is the same as 
+        self.getDataset(name).
+        """
+        if name in self.__dict__.get('datasets', []):
+            return self.getDataset(name)
+        
+        raise AttributeError("'Cluster' object has no attribute '{0}'".format(name))
+    
+    
     def getSpatialReference(self, asWKT=False):
         """
         Returns the used SpatialReference. On default the osr.SpatialReference 
@@ -103,40 +140,97 @@ class Cluster(object):
             return self.SpatialReference
 
     
+    def transform(self, SpatialReference):
+        """
+        All datasets are transformed into SpatialReference, which becomes the 
+        new SpatialReference of this Cluster. The shared coordinates are 
+        transformed in a single call.
+        """
+        if not isinstance(SpatialReference, osr.SpatialReference):
+            raise TypeError("SpatialReference does not have a valid OSR spatial reference type.")
+        
+        if self.coordinates is not None:
+            self.coordinates = spatial.transform_coordinates(self.coordinates, self.SpatialReference, SpatialReference)
+        
+        # directly set DataFrames are transformed geometry by geometry
+        transformation = spatial.get_transformation(self.SpatialReference, SpatialReference)
+        for name, frame in self._frames.items():
+            frame = frame.copy()
+            frame['geometry'] = [geometry.Clone() for geometry in frame.geometry]
+            for geometry in frame.geometry:
+                geometry.Transform(transformation)
+            self._frames[name] = frame
+        
+        self.SpatialReference = SpatialReference
+        self._indices = dict()
+    
+    
+    def getCoordinates(self):
+        """
+        Returns the (n, 2) numpy.ndarray of point coordinates shared by all 
+        datasets.
+        """
+        return self.coordinates
+    
+    
+    def getGeometries(self):
+        """
+        Returns a list of OGR POINT Geometries build from the coordinates. 
+        The Geometries are not stored, each call creates new objects.
+        """
+        if self.coordinates is None:
+            return []
+        return spatial.ArrayToPoint(self.coordinates)
+    
+    
+    def getValues(self, name):
+        """
+        Returns the values of the dataset identified by name as numpy.ndarray.
+        """
+        if name in self._values:
+            return self._values[name]
+        
+        return np.asarray(self.getDataset(name).value)
+    
+    
     def getDatasets(self, objects=False):
         """
         Returns all names of all datasets in this instance as list. If objects 
         is True, the DataFrames are also returned in a dict of 'name':DataFrame.
         """
         if objects:
-            return {dataset:getattr(self, dataset) for dataset in self.datasets}
+            # the Geometries are build only once for all datasets
+            if len(self._values) > 0:
+                geometries = self.getGeometries()
+            return {dataset:self._frames[dataset] if dataset in self._frames else 
+                    pd.DataFrame({'geometry':geometries, 'value':self._values[dataset]}) for dataset in self.datasets}
         else:
             return self.datasets
             
     def getDataset(self, name):
         """
         Return the DataFrame identified by name. This is the same as self.name.
+        The DataFrame is build on each call.
         """
-        try:
-            dataset = getattr(self, name)
-        except:
+        if name in self._frames:
+            return self._frames[name]
+        elif name in self._values:
+            return pd.DataFrame({'geometry':self.getGeometries(), 'value':self._values[name]})
+        else:
             raise AttributeError("This Cluster does not have a point cluster called '{0}'.".format(name))
         
-        return dataset
-        
 
     def dropDataset(self, name):
         """
         Returns and then drops the given dataset.
         """
         # check if dataset name is set
-        try:
-            dataset = getattr(self, name)
-        except AttributeError as e:
-            raise AttributeError(e.message)
+        dataset = self.getDataset(name)
         
-        # delete the Attribute
-        delattr(self, name)
+        # delete the data
+        self._values.pop(name, None)
+        if self._frames.pop(name, None) is not None:
+            self._indices.pop(name, None)
         
         # remove the name from self.datasets
         self.datasets.remove(name)
@@ -144,6 +238,34 @@ class Cluster(object):
         # return the deleted object
         return dataset
         
+    def append(self, DataFrame, geometry_column=None):
+        """
+        The rows of DataFrame are appended to the datasets of this Cluster. 
+        DataFrame is parsed like on initialization and has to contain a value 
+        column for each point dataset of this Cluster and no other. The 
+        geometries have to be in the SpatialReference of this Cluster.
+        """
+        other = Cluster(DataFrame, SpatialReference=self.SpatialReference, geometry_column=geometry_column)
+        
+        if set(other.datasets) != set(self._values):
+            raise AttributeError("The DataFrame columns {0} do not match the datasets {1}.".format(other.datasets, list(self._values)))
+        
+        if self.coordinates is None:
+            self.coordinates = other.coordinates
+        else:
+            self.coordinates = np.concatenate((self.coordinates, other.coordinates))
+        
+        # the point set changed
+        self._indices.pop(None, None)
+        
+        for name in other.datasets:
+            if name in self._values:
+                self._values[name] = np.concatenate((self._values[name], other._values[name]))
+            else:
+                self._values[name] = other._values[name]
+                self.datasets.append(name)
+        
+        
     def _setDataset(self, DataFrame, name):
         """
         Direct setting of Datasets. This is only enabled in debug mode.
@@ -153,10 +275,111 @@ class Cluster(object):
             raise Exception("Direct DataFrame setting is only available in debug mode.")
         
         # set Dataset
-        setattr(self, name, DataFrame)
+        self._frames[name] = DataFrame
         
         # set name
         self.datasets.append(name)
+    
+    
+    def _setColumns(self, coordinates, values, datasets=None):
+        """
+        Direct setting of the shared coordinates and a dict of value arrays.
+        This is only enabled in debug mode. datasets gives the order the
+        names are appended in, if None the order of values is used.
+        The arrays are NOT checked and NOT copied, thus memory-mapped arrays
+        stay memory-mapped.
+        """
+        if not self.debug:
+            raise Exception("Direct column setting is only available in debug mode.")
+    
+        self.coordinates = coordinates
+        self._indices.pop(None, None)
+    
+        for name in (datasets if datasets is not None else list(values)):
+            if name not in self._values:
+                self.datasets.append(name)
+            self._values[name] = values[name]
+    
+    
+    def _points(self, name):
+        """
+        Returns the coordinates and values of the dataset identified by name 
+        as numpy arrays. Directly set DataFrames are converted.
+        """
+        if name in self._values:
+            return self.coordinates, self._values[name]
+        
+        data = self.getDataset(name)
+        return spatial.dfToArray(data), np.asarray(data.value)
+    
+    
+    def _index(self, name):
+        """
+        Returns the dict of spatial indices for the points of the dataset name. 
+        All datasets sharing the Cluster coordinates share one dict.
+        """
+        key = None if name in self._values else name
+        
+        # check the dataset
+        if key is not None:
+            self.getDataset(name)
+        
+        return self._indices.setdefault(key, dict())
+    
+    
+    def _triangulation(self, name, polygons=False):
+        """
+        Returns the Delaunay triangulation for the points of the dataset name 
+        and its offset. qhull loses precision on large absolute coordinates, 
+        thus the points are triangulated relative to the offset, which has to 
+        be subtracted from all locations passed to the triangulation. 
+        If polygons is True, the list of OGR POLYGON triangles is returned as 
+        well. All datasets sharing the Cluster coordinates share one 
+        triangulation, both are computed only once.
+        """
+        index = self._index(name)
+        
+        if 'delaunay' not in index:
+            coordinates, _ = self._points(name)
+            coordinates = np.asarray(coordinates, dtype=np.float64)
+            
+            # create Delaunay object relative to the center of the extent
+            index['offset'] = (coordinates.min(axis=0) + coordinates.max(axis=0)) / 2
+            index['delaunay'] = Delaunay(coordinates - index['offset'])
+        
+        delaunayObject, offset = index['delaunay'], index['offset']
+        if not polygons:
+            return delaunayObject, offset
+        
+        if 'polygons' not in index:
+            # get the triangle points
+            tri = (delaunayObject.points + offset)[delaunayObject.simplices]
+            
+            ### the tri does only contain the edges points, for converting to 
+            # polygons, the first point has to be appended to close the structure
+            triangle = np.concatenate((tri, tri[:, :1]), axis=1)
+            
+            #create OGR Geomteries
+            polys = spatial.ArrayToPolygon(triangle)
+            if not isinstance(polys, list):
+                polys = [polys]
+            index['polygons'] = polys
+        
+        return delaunayObject, offset, index['polygons']
+    
+    
+    def _tree(self, name):
+        """
+        Returns the cKDTree of the points of the dataset name. It is build 
+        only once for all datasets sharing the Cluster coordinates.
+        """
+        index = self._index(name)
+        
+        if 'tree' not in index:
+            coordinates, _ = self._points(name)
+            index['tree'] = cKDTree(coordinates)
+        
+        return index['tree']
         
 
     def model(self, func, clusters, as_list=True, inplace=False, **kwargs):
@@ -203,77 +426,141 @@ class Cluster(object):
         """
         Delaunay triangulation is used to create a triangle connecting three 
         neighbouring points. For each triangle an interpolated value using 
-        given func aggregation function is given. The geometries and values are 
-        exported as pandas.DataFrame.
+        given func aggregation function is given. func can be one of 'mean', 
+        'median', 'min', 'max' or a function accepting an array of shape 
+        (triangles, 3) and axis=1. The geometries and values are exported as 
+        pandas.DataFrame.
         This Dataframe has a 'geometry' column containing the OGR POLYGON 
         Geometry objects and a 'value' column containing the values.
+        The triangulation is computed once and reused for all datasets of this 
+        Cluster, thus the returned POLYGON Geometries are shared as well.
         """
-#        try:
-#            data = getattr(self, cluster)
-#        except:
-#            raise AttributeError("This Cluster does not have a point cluster called '{0}'.".format(cluster))
-        data = self.getDataset(cluster)
-        
-        # create Delaunay object
-        delaunayObject = Delaunay(spatial.dfToArray(data))
+        func = _aggregation(func)
         
-        # get the triangle points
-        tri = delaunayObject.points[delaunayObject.simplices]
-        
-        ### the tri does only contain the edges points, for converting to 
-        # polygons, the first point has to be appended to close the structure
-        # TODO: translate into pure numpy , maybe use insert or concat
-        triangle = np.asarray([[x[0], x[1], x[2], x[0]] for x in tri.tolist()])
-        
-#        # mindfuck
-#        strings = []
-#        for obj in triangle:
-#            strings.append(','.join(["{0} {1}".format(x[0], x[1]) for x in obj]))
-#            
-#        # create OGR POLYGON Geometry objects
-#        polys = [ogr.CreateGeometryFromWkt("POLYGON (({0}))".format(x)) for x in strings]
-        #create OGR Geomteries
-        polys = spatial.ArrayToPolygon(triangle)
+        data = self.getValues(cluster)
+        delaunayObject, _, polys = self._triangulation(cluster, polygons=True)
         
         #delaunayObject.simplices stores the indices of correct points
-        values = [data.value[x].mean() for x in delaunayObject.simplices]
+        values = func(data[delaunayObject.simplices], axis=1)
         
         return pd.DataFrame({'geometry':polys, 'value':values}), self.getSpatialReference()
     
     
+    def interpolate(self, cluster, target):
+        """
+        The values of cluster are linearly interpolated at the given target 
+        locations using the Delaunay triangulation of the points. target is 
+        either a locomotif.Grid, then the cell midpoints are used, or a (n, 2) 
+        numpy.ndarray of coordinates in the Cluster SpatialReference.
+        All locations are located in the triangulation at once and weighted 
+        by their barycentric coordinates. Locations outside the convex hull of 
+        the points are NaN. For implicit raster grids the result is returned 
+        as (rows, cols) numpy.ndarray, otherwise as array of n values.
+        """
+        # get the target locations
+        if hasattr(target, 'getCentroids'):
+            points = spatial.transform_coordinates(target.getCentroids(), target.getSpatialReference(), self.getSpatialReference())
+            shape = target.shape
+        else:
+            points = np.asarray(target, dtype=np.float64).reshape(-1, 2)
+            shape = None
+        
+        data = np.asarray(self.getValues(cluster), dtype=np.float64)
+        delaunayObject, offset = self._triangulation(cluster)
+        points = points - offset
+        
+        # locate all points, -1 is outside
+        simplex = delaunayObject.find_simplex(points)
+        
+        # barycentric coordinates
+        transform = delaunayObject.transform[simplex]
+        b = np.einsum('ijk,ik->ij', transform[:, :2], points - transform[:, 2])
+        weights = np.column_stack((b, 1 - b.sum(axis=1)))
+        
+        values = np.einsum('ij,ij->i', data[delaunayObject.simplices[simplex]], weights)
+        values[simplex < 0] = np.nan
+        
+        if shape is not None:
+            values = values.reshape(shape)
+        
+        return values
+    
+    
+    def query(self, cluster, coordinates, method='voronoi', func='mean'):
+        """
+        Returns the cell index and value of the Cluster.voronoi or 
+        Cluster.delaunay result of cluster at all given (n, 2) coordinates, 
+        without building any Geometry. The index is the row of the result 
+        DataFrame.
+        For method='voronoi' the nearest point is searched in a KD-tree, for 
+        method='delaunay' the triangle is located in the triangulation and 
+        aggregated by func like in Cluster.delaunay. Coordinates outside the 
+        triangulation get index -1 and NaN. The index and values are 
+        returned as tuple of numpy.ndarrays.
+        """
+        coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        data = self.getValues(cluster)
+        
+        if method == 'voronoi':
+            _, index = self._tree(cluster).query(coordinates)
+            return index, data[index]
+        
+        elif method == 'delaunay':
+            func = _aggregation(func)
+            delaunayObject, offset = self._triangulation(cluster)
+            
+            index = delaunayObject.find_simplex(coordinates - offset)
+            inside = index >= 0
+            
+            values = np.full(len(index), np.nan)
+            if inside.any():
+                values[inside] = func(data[delaunayObject.simplices[index[inside]]], axis=1)
+            return index, values
+        
+        else:
+            raise AttributeError("method has to be 'voronoi' or 'delaunay', found {0}.".format(method))
+    
+    
     def voronoi(self, cluster, frame=None, debug=False):
         """
         Voronoi Polygons are created around each point. All edge points out of 
         bounds and at infinity are calculated to the intersection with bounds.
-        The used function in locomotif.spatial.voronoi are from neothemachine (GitHub) at:
-        https://gist.github.com/neothemachine/8803860
+        The polygons are computed by locomotif.spatial.voronoi as dual of the 
+        Delaunay triangulation. Duplicated points get the same polygon.
         The outer Polygons exceeding the point cluster dimensions are clipped by 
         frame. This can be of any closed polygon shape. As a numpy.ndarray of four 
         points is given, the bouding box will be created of this. If frame is None,
         the boundary will be computed from the Point cluster. 
+        Rectangular and convex frames clip all polygons at once on their vertex 
+        arrays, only other shapes are intersected polygon by polygon using OGR.
         If debug is True and the Cluster instance is in debug mode, this function
         will return [frame, vor, out,  raw, polys, value]. Do only use if you 
         know what this means
         """
         ### Process Data ###
         # get the clsuter
-        data = self.getDataset(cluster)
+        coordinates, data = self._points(cluster)
         
         ### Check Input Data ###
         # frame is an Geometry, check if its a Polygon
         if isinstance(frame, ogr.Geometry):
             if frame.GetGeometryName() != 'POLYGON':
                 raise TypeError("frame has to be of Geometry type 'POLYGON', but is {0}.".format(frame.GetGeometryName()))
+            e = frame.GetEnvelope()
+            
+            # convex frames without holes can be clipped vectorized
+            area = frame.GetArea()
+            if frame.GetGeometryCount() == 1 and frame.ConvexHull().GetArea() - area <= 1e-9 * area:
+                clip = np.array(frame.GetGeometryRef(0).GetPoints())
+            else:
+                clip = None
         else:
             # get the Envelope of all Points
             if frame is None:
-                geocollection = ogr.Geometry(ogr.wkbGeometryCollection)
-                # add all points
-                [geocollection.AddGeometry(point) for point in data.geometry]
-                
-                # create edge points
-                e = geocollection.GetEnvelope()
-                # envelope returns [minX, maxX, minY, maxY]
+                # create edge points like an envelope [minX, maxX, minY, maxY]
+                minimum = coordinates.min(axis=0)
+                maximum = coordinates.max(axis=0)
+                e = [minimum[0], maximum[0], minimum[1], maximum[1]]
             
             # frame is a list of maximum points
             elif isinstance(frame, list):
@@ -284,36 +571,40 @@ class Cluster(object):
             else:
                 raise TypeError("frame has to be a POLYGON, list or None, found {0}.".format(frame.__class__))
             
+            clip = list(e)
+            
             # create the frame
             frame = ogr.CreateGeometryFromWkt("POLYGON (({0} {1}, {2} {3}, {4} {5}, {6} {7}, {8} {9}))".format(
                 e[0], e[2], e[1], e[2], e[1], e[3], e[0], e[3], e[0], e[2]))
         
-        try:
-            vor = voronoi.polygons(spatial.dfToArray(data))
-        except AssertionError:
-            raise Exception("The Points are maybe too close together for Voronoi Polygons. Use Delaunay or transform your points.")
+        vor = voronoi.polygons(coordinates, bounds=e)
 
-        if not len(vor) == len(data.value):
-            raise Exception("For some reason number of points and polygons do not match.\nFound:\n points:\t{0}\n polygons:{1}".format(len(data.value), len(vor)))
+        if not len(vor) == len(data):
+            raise Exception("For some reason number of points and polygons do not match.\nFound:\n points:\t{0}\n polygons:{1}".format(len(data), len(vor)))
+        
+        # clip all polygons at once
+        if clip is not None:
+            raw = spatial.clip_polygons(vor, clip)
+        else:
+            raw = vor
         
         ### the vor does only contain the edges points, for converting to 
         # polygons, the first point has to be appended to close the structure
-        out = []        
-        for obj in vor:
-            x = obj.tolist()
-            x.append(x[0])
-            out.append(np.asarray(x))
+        out = [np.concatenate((obj, obj[:1])) for obj in raw]
         
-        raw = spatial.ArrayToPolygon(out)
+        polys = spatial.ArrayToPolygon(out)
+        if not isinstance(polys, list):
+            polys = [polys]
         
-        # intersect all polygons with frame
-        polys = [poly.Intersection(frame) for poly in raw]
+        # intersect all polygons with other frames
+        if clip is None:
+            polys = [poly.Intersection(frame) for poly in polys]
         
         ### debug mode output ###
         if debug and self.debug:
-            return [frame, vor, out,  raw, polys, data.value]
+            return [frame, vor, out,  raw, polys, data]
 
-        return pd.DataFrame({'geometry':polys, 'value':data.value}), self.getSpatialReference()
+        return pd.DataFrame({'geometry':polys, 'value':data}), self.getSpatialReference()
     
     
     def setDebug(self, boolean=None):
@@ -324,5 +615,16 @@ class Cluster(object):
             return self.debug            
         else:
             self.debug = bool(boolean)
-        
-            
+
+
+def _aggregation(func):
+    """
+    Returns the aggregation function for triangle values. func can be one of 
+    'mean', 'median', 'min', 'max' or a callable accepting axis=1.
+    """
+    if func in _AGGREGATIONS:
+        return _AGGREGATIONS[func]
+    elif not hasattr(func, '__call__'):
+        raise AttributeError("func has to be one of {0} or callable, found {1}.".format(sorted(_AGGREGATIONS), func))
+    
+    return func
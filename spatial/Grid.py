@@ -10,9 +10,18 @@ import spatial
 class Grid(object):
     """
     """
-    def __init__(self, data, SpatialReference):
+    def __init__(self, data, SpatialReference, transform=None, shape=None):
         """
+        data is a list of OGR POLYGON Geometries or an array of grid cells. 
+        If data is None, an implicit raster grid is defined by transform and 
+        shape. transform is a GDAL like geotransform of 
+        (originX, cellWidth, rowRotation, originY, columnRotation, cellHeight) 
+        and shape is (rows, cols). Cell midpoints and corners of an implicit 
+        grid are computed on demand, OGR Geometries are only build on export.
         """
+        # implicit grids only
+        self.geotransform = None
+        self.shape = None
         
         # check if SpatialReference is of type osr.SpatialReference
         if SpatialReference.__class__ != osr.SpatialReference().__class__:
@@ -21,7 +30,19 @@ class Grid(object):
             self.SpatialReference = SpatialReference
         
         
-        if data.__class__ == list:
+        if data is None:
+            if transform is None or shape is None:
+                raise AttributeError("If data is None, the grid has to be defined by transform and shape.")
+            if len(transform) != 6:
+                raise TypeError("transform has to be given as (originX, cellWidth, rowRotation, originY, columnRotation, cellHeight).")
+            if len(shape) != 2 or not all(int(n) == n and n > 0 for n in shape):
+                raise TypeError("shape has to be given as (rows, cols) of positive integers, found {0}.".format(shape))
+            
+            self.geotransform = tuple(float(x) for x in transform)
+            self.shape = (int(shape[0]), int(shape[1]))
+            self.data = None
+        
+        elif data.__class__ == list:
             # check all elements
             if not all(isinstance(geom, ogr.Geometry) for geom in data):
                 # check for beeing list of OGR geometries
@@ -50,6 +71,95 @@ class Grid(object):
             return self.SpatialReference
 
     
+    def transform(self, SpatialReference):
+        """
+        All grid cells are transformed into SpatialReference, which becomes 
+        the new SpatialReference of the Grid. The transformation is done in a 
+        single call for all cells.
+        """
+        if not isinstance(SpatialReference, osr.SpatialReference):
+            raise TypeError("SpatialReference does not have a valid OSR spatial reference type.")
+        
+        if self.data is None:
+            raise TypeError("An implicit raster grid cannot be transformed, transform the point clusters instead.")
+        
+        if isinstance(self.data, list):
+            transformation = spatial.get_transformation(self.SpatialReference, SpatialReference)
+            data = [cell.Clone() for cell in self.data]
+            for cell in data:
+                cell.Transform(transformation)
+            self.data = data
+        else:
+            shape = self.data.shape
+            coordinates = spatial.transform_coordinates(self.data[..., :2].reshape(-1, 2), self.SpatialReference, SpatialReference)
+            self.data = coordinates.reshape(shape[:-1] + (2,))
+        
+        self.SpatialReference = SpatialReference
+    
+    
+    def getCentroids(self):
+        """
+        Returns the midpoints of all grid cells as (n, 2) numpy.ndarray. 
+        Cells of implicit grids are ordered row by row.
+        """
+        if self.data is None:
+            rows, cols = np.meshgrid(np.arange(self.shape[0]) + 0.5, np.arange(self.shape[1]) + 0.5, indexing='ij')
+            return self._cellToXY(rows.ravel(), cols.ravel())
+        elif isinstance(self.data, list):
+            return np.array([cell.Centroid().GetPoint_2D() for cell in self.data], dtype=np.float64).reshape(-1, 2)
+        elif self.data.ndim == 3:
+            # dl, dr, ur, ul and closing dl corner
+            return self.data[:, :4, :2].mean(axis=1)
+        else:
+            # the cells are already given as midpoints
+            return self.data[:, :2].astype(np.float64)
+    
+    
+    def getCorners(self):
+        """
+        Returns the dl, dr, ur, ul and closing dl corner of all grid cells as 
+        (n, 5, 2) numpy.ndarray. Only available for implicit and array grids.
+        """
+        if self.data is None:
+            rows, cols = np.meshgrid(np.arange(self.shape[0]), np.arange(self.shape[1]), indexing='ij')
+            
+            # the lower and left cell edge depend on the signs of cellHeight and cellWidth
+            down = 1 if self.geotransform[5] < 0 else 0
+            left = 0 if self.geotransform[1] > 0 else 1
+            rows = rows.ravel()[:, np.newaxis] + np.array([down, down, 1 - down, 1 - down, down])
+            cols = cols.ravel()[:, np.newaxis] + np.array([left, 1 - left, 1 - left, left, left])
+            return self._cellToXY(rows.ravel(), cols.ravel()).reshape(-1, 5, 2)
+        elif not isinstance(self.data, list) and self.data.ndim == 3:
+            return self.data[..., :2]
+        else:
+            raise TypeError("The grid cells are not given as corner points.")
+    
+    
+    def getGeometries(self):
+        """
+        Returns all grid cells as list of OGR Geometries. For implicit and 
+        array grids, the Geometries are build on each call.
+        """
+        if isinstance(self.data, list):
+            return self.data
+        elif self.data is not None and self.data.ndim == 2:
+            return spatial.ArrayToPoint(self.data)
+        
+        polys = spatial.ArrayToPolygon(self.getCorners())
+        if not isinstance(polys, list):
+            polys = [polys]
+        return polys
+    
+    
+    def _cellToXY(self, rows, cols):
+        """
+        Applies the geotransform of an implicit grid to the (fractional) row and 
+        column indices. Returns the (n, 2) numpy.ndarray of coordinates.
+        """
+        t = self.geotransform
+        return np.column_stack((t[0] + cols * t[1] + rows * t[2], t[3] + cols * t[4] + rows * t[5]))
+    
+    
     def setCluster(self, DataFrame, geometry_column=None, parse_geometry=True):
         """
         Set a new point cluster for the Grid. This contains a point cloud of 
@@ -95,12 +205,13 @@ class Grid(object):
     
                 
     
-    def voronoi(self, cluster,  SpatialReference=None, wgs84=True, as_array=False, inplace=False):
+    def voronoi(self, cluster,  SpatialReference=None, wgs84=True, as_array=False, inplace=False, dataset=None):
         """
         An Voronoi diagram is computed from the given point cloud. These points 
         should be included in the underlying grid, otherwise this function might 
         lead to undefined behaviour. The point cloud cluster is identified by 
-        its name and had to be set beforehand using Grid.setCluster.
+        its name and had to be set beforehand using Grid.setCluster. Instead, 
+        a locomotif.Cluster can be given as cluster and dataset as its name.
         SpatialReference shall be given for the points in the cluster, otherwise 
         they will be transformed to the grid spatial reference system. At this 
         stage this tranformation is not supported yet.
@@ -108,12 +219,18 @@ class Grid(object):
         basis of EPSG:4326.
         If Spatial Reference is none and wgs84 is True, WGS84, EPSG 4326 will 
         be used by default.
-        
+        If as_array is True, only the values are returned as numpy.ndarray, in 
+        the shape (rows, cols) for implicit raster grids. No Geometries are build.
         """
         from osgeo import osr
         import pandas as pd
                     
+        # check if given cluster exists
+        coordinates, values, reference = self._getLayer(cluster, dataset)
+        
         # check SpatialReference
+        if SpatialReference is None and reference is not None:
+            SpatialReference = reference
         if SpatialReference is None and wgs84:
             # Use EPSG: 4326 (WGS84) as default
             SpatialReference = osr.SpatialReference()
@@ -125,6 +242,183 @@ class Grid(object):
 #        if not self.SpatialReference.IsSame(SpatialReference):
 #            raise Warning('At this stage only operations within the same SpatialReference are supported.')
 
+        ### now, cluster is a list of points and spatial reference is the same ###
+        from scipy.spatial import cKDTree
+        
+        # get cell midpoints and sample points in EPSG:4326
+        cells = spatial.transform_coordinates(self.getCentroids(), self.getSpatialReference())
+        samples = spatial.transform_coordinates(coordinates, SpatialReference)
+        
+        ### find the nearest sample point for all grid cells at once ###
+        # the nearest point on the unit sphere is the geodesic nearest point
+        tree = cKDTree(spatial.to_unit_sphere(samples))
+        _, idx = tree.query(spatial.to_unit_sphere(cells))
+        
+        voronoi = values[idx]
+        
+        if as_array:
+            if self.shape is not None:
+                voronoi = voronoi.reshape(self.shape)
+            return voronoi, self.getSpatialReference()
+        
+        result = pd.DataFrame({dataset if dataset is not None else cluster:voronoi, 'geom':self.getGeometries()})
+        return result, self.getSpatialReference()
+    
+    
+    def idw(self, cluster, dataset=None, k=8, power=2, radius=None, blocksize=100000, SpatialReference=None, wgs84=True, as_array=False):
+        """
+        Inverse distance weighted interpolation of the point cluster onto all 
+        grid cells. For each cell midpoint the k nearest points are searched 
+        by a KD-tree and weighted by 1 / distance**power. If radius is given 
+        in [m], only points within radius are used, cells without any point 
+        in radius are NaN. A point at a cell midpoint gets the full weight.
+        The distances are geodesic distances on the basis of EPSG:4326, 
+        SpatialReference, cluster, dataset, wgs84 and as_array are handled 
+        like in Grid.voronoi. The cells are processed in blocks of blocksize 
+        cells, no full distance matrix is build.
+        """
+        from osgeo import osr
+        from scipy.spatial import cKDTree
+        
+        coordinates, values, reference = self._getLayer(cluster, dataset)
+        
+        # check SpatialReference
+        if SpatialReference is None and reference is not None:
+            SpatialReference = reference
+        if SpatialReference is None and wgs84:
+            # Use EPSG: 4326 (WGS84) as default
+            SpatialReference = osr.SpatialReference()
+            SpatialReference.ImportFromEPSG(4326)
+        
+        # NaN values cannot be interpolated
+        values = np.asarray(values, dtype=np.float64)
+        valid = np.isfinite(values)
+        coordinates = coordinates[valid]
+        values = values[valid]
+        if len(values) == 0:
+            raise AttributeError("The point cluster {0} does not contain any valid value.".format(cluster))
+        
+        # get cell midpoints and sample points on the unit sphere
+        cells = spatial.to_unit_sphere(spatial.transform_coordinates(self.getCentroids(), self.getSpatialReference()))
+        tree = cKDTree(spatial.to_unit_sphere(spatial.transform_coordinates(coordinates, SpatialReference)))
+        
+        # radius as chord length on the unit sphere
+        R = spatial.EARTH_RADIUS * 1000.
+        if radius is None:
+            bound = np.inf
+        else:
+            bound = 2 * np.sin(min(radius / (2 * R), np.pi / 2))
+        k = min(k, len(values))
+        
+        result = np.empty(len(cells))
+        for start in range(0, len(cells), blocksize):
+            block = cells[start:start + blocksize]
+            chord, idx = tree.query(block, k=k, distance_upper_bound=bound)
+            chord = chord.reshape(len(block), k)
+            idx = idx.reshape(len(block), k)
+            
+            # missing neighbours are inf and indexed by len(values)
+            found = np.isfinite(chord)
+            idx[~found] = 0
+            distance = 2 * R * np.arcsin(np.minimum(1, np.where(found, chord, 0) / 2))
+            
+            with np.errstate(divide='ignore', invalid='ignore'):
+                weights = np.where(found, 1. / distance ** power, 0)
+                
+                # exact hits get all weight
+                exact = found & (distance == 0)
+                hit = exact.any(axis=1)
+                weights[hit] = exact[hit]
+                
+                result[start:start + len(block)] = np.sum(weights * values[idx], axis=1) / np.sum(weights, axis=1)
+        
+        if as_array:
+            if self.shape is not None:
+                result = result.reshape(self.shape)
+            return result, self.getSpatialReference()
+        
+        result = pd.DataFrame({dataset if dataset is not None else cluster:result, 'geom':self.getGeometries()})
+        return result, self.getSpatialReference()
+    
+    
+    def binning(self, cluster, dataset=None, SpatialReference=None, as_array=False):
+        """
+        All points of the cluster are binned into the cells of an implicit 
+        raster grid. For each cell the 'count', 'sum', 'mean', 'min', 'max' and 
+        'std' (population standard deviation) of the point values are computed 
+        in one pass. Cells without points have a count of 0 and NaN otherwise.
+        Points out of the grid and NaN values are ignored.
+        cluster is the name of a point cluster set by Grid.setCluster or a 
+        locomotif.Cluster, then dataset gives the dataset name. The points are 
+        transformed from SpatialReference, or the Cluster's reference, into 
+        the Grid reference. If None, the points are assumed in Grid reference.
+        Returns a pandas.DataFrame of one column per statistic and a 'geom' 
+        column, or if as_array is True a dict of (rows, cols) numpy.ndarrays, 
+        together with the Grid SpatialReference.
+        """
+        if self.data is not None:
+            raise TypeError("Binning is only available for implicit raster grids.")
+        
+        coordinates, values, reference = self._getLayer(cluster, dataset)
+        if SpatialReference is None:
+            SpatialReference = reference
+        
+        # get the points in grid reference
+        coordinates = spatial.transform_coordinates(coordinates, SpatialReference, self.getSpatialReference())
+        values = np.asarray(values, dtype=np.float64)
+        
+        ### map each point to its cell ###
+        t = self.geotransform
+        inverse = np.linalg.inv(np.array([[t[1], t[2]], [t[4], t[5]]]))
+        cols, rows = np.floor(np.dot(coordinates - [t[0], t[3]], inverse.T)).T
+        
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1]) & np.isfinite(values)
+        idx = (rows[inside] * self.shape[1] + cols[inside]).astype(np.intp)
+        values = values[inside]
+        n = self.shape[0] * self.shape[1]
+        
+        ### reduce per cell ###
+        stats = dict()
+        stats['count'] = np.bincount(idx, minlength=n)
+        stats['sum'] = np.bincount(idx, weights=values, minlength=n)
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stats['mean'] = stats['sum'] / stats['count']
+            stats['std'] = np.sqrt(np.bincount(idx, weights=(values - stats['mean'][idx]) ** 2, minlength=n) / stats['count'])
+        stats['sum'][stats['count'] == 0] = np.nan
+        
+        # min and max on the points sorted by cell
+        order = np.argsort(idx, kind='mergesort')
+        idx = idx[order]
+        values = values[order]
+        starts = np.flatnonzero(np.concatenate(([True], idx[1:] != idx[:-1]))) if len(idx) > 0 else np.array([], dtype=np.intp)
+        for name, func in (('min', np.minimum), ('max', np.maximum)):
+            stats[name] = np.full(n, np.nan)
+            if len(starts) > 0:
+                stats[name][idx[starts]] = func.reduceat(values, starts)
+        
+        if as_array:
+            return {name:stat.reshape(self.shape) for name, stat in stats.items()}, self.getSpatialReference()
+        
+        result = pd.DataFrame(stats, columns=['count', 'sum', 'mean', 'min', 'max', 'std'])
+        result['geom'] = self.getGeometries()
+        return result, self.getSpatialReference()
+    
+    
+    def _getLayer(self, cluster, dataset=None):
+        """
+        Returns the coordinates, values and SpatialReference of a point 
+        cluster. cluster is either the name of a point cluster set by 
+        Grid.setCluster or a locomotif.Cluster, then dataset has to give the 
+        dataset. The SpatialReference of Grid point clusters is unknown (None).
+        """
+        # a locomotif.Cluster
+        if hasattr(cluster, 'getCoordinates'):
+            if dataset is None:
+                raise AttributeError("If cluster is a locomotif.Cluster, the dataset has to be given.")
+            coordinates, values = cluster._points(dataset)
+            return coordinates, np.asarray(values), cluster.getSpatialReference()
+        
         # check if given cluster exists
         try:
             layer = getattr(self, cluster)
@@ -134,33 +428,5 @@ class Grid(object):
         if layer.__class__ != pd.DataFrame().__class__:
             raise AttributeError('The point cluster {0} is corrupted. Type pandas.DataFrame is needed, found {1}'.format(cluster, layer.__class__))
         
-        ### now, cluster is a list of points and spatial reference is the same ###
-
-        # container for the voroni areas
-        # it has to have the same length of 1st dim of self.data
-        # one value per cell        
-        voronoi = np.ndarray(len(self.data))  
-        
-        ### create a distance map for all grid cells ###
-        # for each cell, all distances to each point in the cluster is calculated
-        # the value of minimum
-        
-        # iterate data
-        for i, cell in enumerate(self.data):
-            # get midpoint as OGR Geometry
-#            mid = spatial.rect_midpoint(cell, True)
-            mid = cell.Centroid()
-            
-            # get all distances
-            # TODO: ref_x and ref_y have to be given aswell as soon as geodesic_distance will convert correctly
-            distance_map = layer['geometry'].apply(spatial.geodesic_distance, y=mid, ref_x=self.getSpatialReference(), ref_y=SpatialReference)
-            
-            # get the value of minimum
-            idx = distance_map.idxmin()
-            voronoi[i] = layer.value[idx]
-        
-        
-        result = pd.DataFrame({cluster:voronoi, 'geom':self.data})
-        # TODO: try to speed up this function
-        return result, self.getSpatialReference()
-    
\ No newline at end of file
+        return spatial.dfToArray(layer), np.asarray(layer.value), None
+    
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 """
 """
+import threading
 
+# osr.CoordinateTransformation objects are not thread safe, cache per thread
+_TRANSFORMATIONS = threading.local()
 
 def get_edges(df, margins=None, relative=True, geometry_column='geom'):
     """
@@ -100,13 +103,15 @@ def dfToArray(DataFrame):
     
 def ArrayToPolygon(Array):
     """
-    A OGR POLYGON Geometry is build from the given np.ndarray.
+    A OGR POLYGON Geometry is build from the given np.ndarray. A list of 
+    arrays with different numbers of vertices can be given as well. Empty 
+    arrays result in empty POLYGON Geometries.
     """
     import numpy as np
     from osgeo import ogr
     
     # check datatype
-    if not isinstance(Array, np.ndarray):
+    if not isinstance(Array, (np.ndarray, list)):
         try:
             Array = np.asanyarray(Array)
         except:
@@ -126,7 +131,7 @@ def ArrayToPolygon(Array):
         strings.append(','.join(["{0} {1}".format(x[0], x[1]) for x in obj]))
             
     # create OGR POLYGON Geometry objects
-    polys = [ogr.CreateGeometryFromWkt("POLYGON (({0}))".format(x)) for x in strings]
+    polys = [ogr.CreateGeometryFromWkt("POLYGON (({0}))".format(x) if x else "POLYGON EMPTY") for x in strings]
     
     if len(polys) == 1:
         return polys[0]
@@ -134,6 +139,124 @@ def ArrayToPolygon(Array):
         return polys
 
 
+def ArrayToPoint(Array):
+    """
+    OGR POINT Geometries are build from the given (n, 2) np.ndarray of x and y 
+    coordinates. In contrast to ArrayToPolygon no WKT strings are involved, 
+    the coordinates are set directly on each Geometry. Always returns a list.
+    """
+    import numpy as np
+    from osgeo import ogr
+    
+    # check datatype
+    try:
+        Array = np.asarray(Array, dtype=np.float64)
+    except (TypeError, ValueError):
+        raise TypeError("Array is not of type numpy.ndarray and cannot be casted.\n Type: {0}".format(Array.__class__))
+    
+    if Array.ndim != 2 or Array.shape[1] < 2:
+        raise TypeError("Array has to be of shape (n, 2), found {0}.".format(Array.shape))
+    
+    # create OGR POINT Geometry objects
+    points = []
+    for x, y in Array[:, :2].tolist():
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(x, y)
+        points.append(point)
+    
+    return points
+
+
+def clip_polygons(polygons, frame):
+    """
+    All polygons are clipped by the convex frame at once. polygons is a list 
+    of (k, 2) np.ndarrays of vertices, the rings do not need to be closed. 
+    frame is either a list of [minX, maxX, minY, maxY] or a (m, 2) np.ndarray 
+    of the convex frame vertices in any orientation.
+    The Sutherland-Hodgman algorithm is applied for each frame edge on the 
+    vertices of all polygons in one vectorized pass. 
+    A list of the clipped polygons is returned in the same order, the rings 
+    are not closed. Polygons out of frame are returned as empty arrays.
+    """
+    import numpy as np
+    
+    ### Get the frame edges ###
+    if isinstance(frame, list) and len(frame) == 4 and not hasattr(frame[0], '__len__'):
+        frame = np.array([[frame[0], frame[2]], [frame[1], frame[2]], [frame[1], frame[3]], [frame[0], frame[3]]], dtype=np.float64)
+    else:
+        frame = np.asarray(frame, dtype=np.float64)[:, :2]
+        # drop the closing point
+        if len(frame) > 1 and np.all(frame[0] == frame[-1]):
+            frame = frame[:-1]
+        # use counter-clockwise order
+        x, y = frame[:, 0], frame[:, 1]
+        if np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y) < 0:
+            frame = frame[::-1]
+    
+    if len(polygons) == 0:
+        return []
+    
+    ### flatten all polygons ###
+    counts = np.array([len(poly) for poly in polygons], dtype=np.intp)
+    vertices = np.concatenate([np.asarray(poly, dtype=np.float64).reshape(-1, 2) for poly in polygons] + [np.empty((0, 2))])
+    owner = np.repeat(np.arange(len(polygons)), counts)
+    
+    for p0, p1 in zip(frame, np.roll(frame, -1, axis=0)):
+        if len(vertices) == 0:
+            break
+        
+        # the next vertex within the same polygon
+        following = _following(counts)
+        
+        # inside is left of the edge
+        edge = p1 - p0
+        d = edge[0] * (vertices[:, 1] - p0[1]) - edge[1] * (vertices[:, 0] - p0[0])
+        inside = d >= 0
+        d_next = d[following]
+        inside_next = inside[following]
+        
+        # the intersection of each crossing segment with the edge
+        crossing = inside != inside_next
+        denominator = np.where(crossing, d - d_next, 1.)
+        t = (d / denominator)[:, np.newaxis]
+        intersection = vertices + t * (vertices[following] - vertices)
+        
+        # each segment emits its intersection and its inside end point
+        emitted = crossing.astype(np.intp) + inside_next
+        candidates = np.empty((len(vertices), 2, 2))
+        candidates[:, 0] = np.where(crossing[:, np.newaxis], intersection, vertices[following])
+        candidates[:, 1] = vertices[following]
+        keep = np.column_stack((emitted >= 1, emitted == 2))
+        
+        vertices = candidates[keep]
+        owner = np.repeat(owner, emitted)
+        counts = np.bincount(owner, minlength=len(polygons))
+    
+    ### remove repeated vertices ###
+    if len(vertices) > 0:
+        following = _following(counts)
+        keep = np.any(vertices != vertices[following], axis=1)
+        vertices = vertices[keep]
+        counts = np.bincount(owner[keep], minlength=len(polygons))
+    
+    return np.split(vertices, np.cumsum(counts)[:-1])
+
+
+def _following(counts):
+    """
+    Returns the index of the next vertex in the same ring for flattened rings 
+    of counts vertices each. The last vertex of each ring points to the first.
+    """
+    import numpy as np
+    
+    starts = np.cumsum(counts) - counts
+    following = np.arange(1, np.sum(counts) + 1)
+    ends = (starts + counts)[counts > 0] - 1
+    following[ends] = starts[counts > 0]
+    
+    return following
+
+
 #### FROM HERE ON, ANYTHING WILL BE DELETED AT PUBLISHING ####
 #### THIS WAS DEVELOPMENT ONLY ####
 def rect_grid(edges, nrows=None, ncols=None, len_x=None, len_y=None, as_geometry=True, as_midpoints=False):
@@ -321,12 +444,13 @@ def geodesic_distance(x, y, ref_x=None, ref_y=None, unit='m'):
     """
     The geodesic distance (on the earth surface) is computed using the 
     haversine function. If ref_x and/or ref_y are None, EPSG:4326 is assumed, 
-    otherwise x and y will be transformed to EPSG:4326. Distance is returned in 
-    [m], other possible values for unit are 'mi' for miles or 'ft' for 'feet'. 
-    The default unit is kilometers if unit is anything else than 'm', 'mi' or 'ft'.
+    otherwise x and y will be transformed to EPSG:4326. The points are read 
+    in lon, lat order. Distance is returned in [m], other possible values for 
+    unit are 'mi' for miles or 'ft' for 'feet'. The default unit is 
+    kilometers if unit is anything else than 'm', 'mi' or 'ft'.
+    For many points use the vectorized haversine or distance_matrix.
     """
     from osgeo import ogr, osr
-    import numpy as np
     
     # check classes of x and y
     # if neccessary transform to OGR point geometry
@@ -353,55 +477,161 @@ def geodesic_distance(x, y, ref_x=None, ref_y=None, unit='m'):
     ### transform objects ###
     if ref_x is not None:
         if ref_x.__class__ == osr.SpatialReference().__class__:
-            transform_x = osr.CoordinateTransformation(ref_x, target)
-            x.Transform(transform_x)
+            x = x.Clone()
+            x.Transform(get_transformation(ref_x, target))
         else:
             raise TypeError('ref_x has to be a valid OSR spatial reference, found type {0}.'.format(ref_x.__class__))
 
     if ref_y is not None:
         if ref_y.__class__ == osr.SpatialReference().__class__:
-            transform_y = osr.CoordinateTransformation(ref_y, target)
-            y.Transform(transform_y)
+            y = y.Clone()
+            y.Transform(get_transformation(ref_y, target))
         else:
             raise TypeError('ref_y has to be a valid OSR spatial reference, found type {0}.'.format(ref_y.__class__))
                 
     ### now, both points are in EPSG:4326 coordinate system ###
     # calculate the distance by using Haversine formula
-    # z is not used here, but served by .GetPoint()
-    x_lat, x_lon, z = x.GetPoint()
-    y_lat, y_lon, z = y.GetPoint()
+    return haversine(x.GetPoint_2D(), y.GetPoint_2D(), unit=unit)
+
+
+def get_transformation(source, target):
+    """
+    Returns the osr.CoordinateTransformation from the source to the target 
+    osr.SpatialReference. Each transformation is created only once per thread 
+    and then served from a cache keyed by the WKT of both references. 
+    Coordinates are always handled in x, y (lon, lat) order.
+    """
+    from osgeo import osr
+    
+    key = (source.ExportToWkt(), target.ExportToWkt())
+    
+    cache = getattr(_TRANSFORMATIONS, 'cache', None)
+    if cache is None:
+        cache = _TRANSFORMATIONS.cache = dict()
+    
+    if key not in cache:
+        source = source.Clone()
+        target = target.Clone()
+        # keep lon, lat order on GDAL >= 3
+        if hasattr(source, 'SetAxisMappingStrategy'):
+            source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        
+        cache[key] = osr.CoordinateTransformation(source, target)
     
-    # get the difference in radians
-    dlon = np.radians(np.abs(y_lon - x_lon))
-    dlat = np.radians(np.abs(y_lat - x_lat))
+    return cache[key]
+
+
+def transform_coordinates(coordinates, source, target=None):
+    """
+    The (n, 2) np.ndarray of coordinates is transformed from the source to 
+    the target osr.SpatialReference in a single call. If target is None, 
+    EPSG:4326 is used. If source is None or the same as target, the 
+    coordinates are returned as they are. Returns a (n, 2) np.ndarray.
+    """
+    import numpy as np
+    from osgeo import osr
     
-    # convert all degrees to radians
-    x_lat = np.radians(x_lat)    
-    y_lat = np.radians(y_lat)    
-    x_lon = np.radians(x_lon)    
-    y_lon = np.radians(y_lon)  
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    
+    if target is None:
+        target = osr.SpatialReference()
+        target.ImportFromEPSG(4326)
+    
+    if source is None or source.IsSame(target) or len(coordinates) == 0:
+        return coordinates
+    
+    transformed = get_transformation(source, target).TransformPoints(coordinates.tolist())
+    
+    return np.array(transformed, dtype=np.float64)[:, :2]
+
+
+# mean earth radius in [km]
+EARTH_RADIUS = 6371.
+
+# conversion factors from [km]
+_UNITS = {'m':1000., 'mi':0.621371192, 'ft':3280.8399, 'km':1.}
+
+
+def haversine(x, y, unit='m'):
+    """
+    Vectorized geodesic distance using the haversine function. x and y are 
+    lon, lat coordinates in EPSG:4326 given as arrays of shape (..., 2), which 
+    are broadcasted against each other:
+    
+        haversine(point, points)                paired or one-to-many, (n,)
+        haversine(x[:, np.newaxis], y)          many-to-many, (n, m)
+    
+    Distance is returned in [m], other possible values for unit are 'mi' for 
+    miles or 'ft' for 'feet'. The default unit is kilometers if unit is 
+    anything else than 'm', 'mi' or 'ft'.
+    """
+    import numpy as np
+    
+    x = np.radians(np.asarray(x, dtype=np.float64))
+    y = np.radians(np.asarray(y, dtype=np.float64))
+    
+    x_lon, x_lat = x[..., 0], x[..., 1]
+    y_lon, y_lat = y[..., 0], y[..., 1]
     
     # haversine
-    a = np.power(np.sin(dlat / 2), 2) + np.cos(x_lat) * np.cos(y_lat) * np.power(np.sin(dlon / 2), 2)
-    c = 2 * np.arcsin(np.min([1, np.sqrt(a)]))
-    
-    # get the earth radius
-    R = 6371   
-    #hier den genauen in abhängigkeit von lat ausrechenen und alles testen    
-    
-    d = R * c
-    
-    # return distance in [m]
-    if unit == 'm':
-        return d * 1000
-    elif unit == 'mi':
-        return d * 0.621371192
-    elif unit == 'ft':
-        return d * 3280.8399
-    else:
-        # return km
-        return d
+    a = np.power(np.sin((y_lat - x_lat) / 2), 2) + np.cos(x_lat) * np.cos(y_lat) * np.power(np.sin((y_lon - x_lon) / 2), 2)
+    c = 2 * np.arcsin(np.minimum(1, np.sqrt(a)))
+    
+    return EARTH_RADIUS * c * _UNITS.get(unit, 1.)
+
+
+def distance_chunks(x, y, chunksize=1000, unit='m'):
+    """
+    Generator over the haversine distance matrix of the (n, 2) coordinates x 
+    and the (m, 2) coordinates y. Blocks of at most chunksize rows are yielded 
+    as tuple of the first row index and the (chunksize, m) distance block, 
+    thus the memory is limited by chunksize * m.
+    """
+    import numpy as np
+    
+    x = np.asarray(x, dtype=np.float64).reshape(-1, 2)
+    y = np.asarray(y, dtype=np.float64).reshape(-1, 2)
+    
+    for start in range(0, len(x), chunksize):
+        yield start, haversine(x[start:start + chunksize, np.newaxis], y, unit=unit)
+
+
+def distance_matrix(x, y, unit='m', chunksize=None):
+    """
+    Returns the (n, m) haversine distance matrix of the (n, 2) coordinates x 
+    and the (m, 2) coordinates y. If chunksize is given, the matrix is filled 
+    in blocks of chunksize rows to limit the temporary memory.
+    """
+    import numpy as np
+    
+    x = np.asarray(x, dtype=np.float64).reshape(-1, 2)
+    y = np.asarray(y, dtype=np.float64).reshape(-1, 2)
+    
+    if chunksize is None:
+        return haversine(x[:, np.newaxis], y, unit=unit)
+    
+    out = np.empty((len(x), len(y)))
+    for start, block in distance_chunks(x, y, chunksize=chunksize, unit=unit):
+        out[start:start + len(block)] = block
+    
+    return out
+
+
+def to_unit_sphere(coordinates):
+    """
+    The (n, 2) np.ndarray of lon, lat coordinates in degree is converted to 
+    (n, 3) cartesian coordinates on the unit sphere. The euclidean distance 
+    of these points grows monotonic with the geodesic distance, thus nearest 
+    neighbours can be searched by a KD-tree.
+    """
+    import numpy as np
+    
+    coordinates = np.radians(np.asarray(coordinates, dtype=np.float64).reshape(-1, 2))
+    lon = coordinates[:, 0]
+    lat = coordinates[:, 1]
     
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
 
 
 def ogrPointToTuple(point):
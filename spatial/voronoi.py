@@ -1,179 +1,110 @@
 # -*- coding: utf-8 -*-
 """
-File from https://gist.github.com/neothemachine/8803860
+Voronoi polygons computed as the dual of the scipy (qhull) Delaunay
+triangulation. Replaces the former implementation taken from
+https://gist.github.com/neothemachine/8803860
 
-@author: neothemachine
+@author: maelicke
 """
 from __future__ import division
-import collections
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-from scipy.spatial import Delaunay, KDTree
+from scipy.spatial import Delaunay
 
-# an adaptation of https://stackoverflow.com/a/15783581/60982
-# using ideas from https://stackoverflow.com/a/9471601/60982
 
-def voronoi(P):
+def circumcenters(triangles):
     '''
-    Returns a list of all edges of the voronoi diagram for the given input points.
-    '''
-    delauny = Delaunay(P)
-    triangles = delauny.points[delauny.vertices]
-
-    circum_centers = np.array([triangle_csc(tri) for tri in triangles])
-    long_lines_endpoints = []
-
-    lineIndices = []
-    for i, triangle in enumerate(triangles):
-        circum_center = circum_centers[i]
-        for j, neighbor in enumerate(delauny.neighbors[i]):
-            if neighbor != -1:
-                lineIndices.append((i, neighbor))
-            else:     
-                ps = triangle[(j+1)%3] - triangle[(j-1)%3]
-                ps = np.array((ps[1], -ps[0]))
-
-                middle = (triangle[(j+1)%3] + triangle[(j-1)%3]) * 0.5
-                di = middle - triangle[j]
-
-                ps /= np.linalg.norm(ps)
-                di /= np.linalg.norm(di)
-
-                if np.dot(di, ps) < 0.0:
-                    ps *= -1000.0
-                else:
-                    ps *= 1000.0
-                    
-                long_lines_endpoints.append(circum_center + ps)                
-                lineIndices.append((i, len(circum_centers) + len(long_lines_endpoints)-1))
-
-    vertices = np.vstack((circum_centers, long_lines_endpoints))
-    
-    # filter out any duplicate lines
-    lineIndicesSorted = np.sort(lineIndices) # make (1,2) and (2,1) both (1,2)
-    lineIndicesTupled = [tuple(row) for row in lineIndicesSorted]
-    lineIndicesUnique = np.unique(lineIndicesTupled)
-    
-    return vertices, lineIndicesUnique
-
-def triangle_csc(pts):
-    rows, cols = pts.shape
-
-    A = np.bmat([[2 * np.dot(pts, pts.T), np.ones((rows, 1))],
-                 [np.ones((1, rows)), np.zeros((1, 1))]])
-
-    b = np.hstack((np.sum(pts * pts, axis=1), np.ones((1))))
-    x = np.linalg.solve(A,b)
-    bary_coords = x[:-1]
-    return np.sum(pts * np.tile(bary_coords.reshape((pts.shape[0], 1)), (1, pts.shape[1])), axis=0)
-
-def voronoi_cell_lines(points, vertices, lineIndices):
-    '''
-    Returns a mapping from a voronoi cell to its edges.
-     
-    :param points: shape (m,2)
-    :param vertices: shape (n,2)
-    :param lineIndices: shape (o,2)
-    :rtype: dict point index -> list of shape (n,2) with vertex indices 
-    '''
-    kd = KDTree(points)
-    
-    cells = collections.defaultdict(list)
-    for i1,i2 in lineIndices:
-        v1,v2 = vertices[i1], vertices[i2]
-        mid = (v1+v2)/2
-        _, (p1Idx,p2Idx) = kd.query(mid, 2)
-        cells[p1Idx].append((i1,i2))
-        cells[p2Idx].append((i1,i2))
-
-    return cells
-
-def voronoi_polygons(cells):
-    '''
-    Transforms cell edges into polygons.
-    
-    :param cells: as returned from voronoi_cell_lines
-    :rtype: dict point index -> list of vertex indices which form a polygon 
+    Returns the circumcenters of all given triangles at once.
+
+    :param triangles: shape (m,3,2)
+    :rtype: array of shape (m,2), degenerated triangles get their centroid
     '''
-    
-    # first, close the outer cells
-    for pIdx,lineIndices_ in cells.items():
-        dangling_lines = []
-        for i1,i2 in lineIndices_:
-            connections = filter(lambda (i1_,i2_): (i1,i2) != (i1_,i2_) and (i1==i1_ or i1==i2_ or i2==i1_ or i2==i2_), lineIndices_)
-            assert 1 <= len(connections) <= 2
-            if len(connections) == 1:
-                dangling_lines.append((i1,i2))
-        assert len(dangling_lines) in [0,2]
-        if len(dangling_lines) == 2:
-            (i11,i12), (i21,i22) = dangling_lines
-            
-            # determine which line ends are unconnected
-            connected = filter(lambda (i1,i2): (i1,i2) != (i11,i12) and (i1 == i11 or i2 == i11), lineIndices_)
-            i11Unconnected = len(connected) == 0
-            
-            connected = filter(lambda (i1,i2): (i1,i2) != (i21,i22) and (i1 == i21 or i2 == i21), lineIndices_)
-            i21Unconnected = len(connected) == 0
-            
-            startIdx = i11 if i11Unconnected else i12
-            endIdx = i21 if i21Unconnected else i22
-            
-            cells[pIdx].append((startIdx, endIdx))
-    
-    # then, form polygons by storing vertex indices in (counter-)clockwise order
-    polys = dict()
-    for pIdx,lineIndices_ in cells.items():
-        # get a directed graph which contains both directions and arbitrarily follow one of both
-        directedGraph = lineIndices_ + [(i2,i1) for (i1,i2) in lineIndices_]
-        directedGraphMap = collections.defaultdict(list)
-        for (i1,i2) in directedGraph:
-            directedGraphMap[i1].append(i2)
-        orderedEdges = []
-        currentEdge = directedGraph[0]
-        while len(orderedEdges) < len(lineIndices_):
-            i1 = currentEdge[1]
-            i2 = directedGraphMap[i1][0] if directedGraphMap[i1][0] != currentEdge[0] else directedGraphMap[i1][1]
-            nextEdge = (i1, i2)
-            orderedEdges.append(nextEdge)
-            currentEdge = nextEdge
-        
-        polys[pIdx] = [i1 for (i1,i2) in orderedEdges]
-    
-    return polys
-
-def polygons(points):
+    triangles = np.asarray(triangles, dtype=np.float64)
+
+    # move the first corner into the origin
+    a = triangles[:, 0]
+    b = triangles[:, 1] - a
+    c = triangles[:, 2] - a
+
+    d = 2 * (b[:, 0] * c[:, 1] - b[:, 1] * c[:, 0])
+    degenerated = d == 0
+    d[degenerated] = 1.
+
+    b2 = np.sum(b * b, axis=1)
+    c2 = np.sum(c * c, axis=1)
+
+    centers = a + np.column_stack(((c[:, 1] * b2 - b[:, 1] * c2) / d,
+                                   (b[:, 0] * c2 - c[:, 0] * b2) / d))
+    centers[degenerated] = triangles[degenerated].mean(axis=1)
+
+    return centers
+
+def polygons(points, bounds=None, tolerance=None):
     '''
     Returns the voronoi polygon for each input point.
-    
+    Four far away points are added to the triangulation, this closes all outer
+    cells. Within bounds, the cells are exactly the ones of the unbounded
+    diagram. The triangulation is done relative to the center of the extent,
+    as qhull loses precision on large absolute coordinates.
+    Duplicated points get the same polygon. Near-duplicates dropped by qhull
+    get the polygon of their nearest vertex, if it is closer than tolerance.
+
     :param points: shape (n,2)
-    :rtype: list of n polygons where each polygon is an array of vertices
+    :param bounds: [minX, maxX, minY, maxY] the cells have to be exact in,
+                   the extent of points is always included
+    :param tolerance: distance up to which dropped points are merged, defaults
+                      to 1e-9 of the extent diagonal
+    :rtype: list of n polygons where each polygon is an array of vertices in
+            counter-clockwise order
     '''
-    vertices, lineIndices = voronoi(points)
-    cells = voronoi_cell_lines(points, vertices, lineIndices)
-    polys = voronoi_polygons(cells)
-    polylist = []
-    for i in xrange(len(points)):
-        poly = vertices[np.asarray(polys[i])]
-        polylist.append(poly)
-    return polylist
-    
-if __name__ == '__main__':
-    P = np.random.random((100,2))
-
-    fig = plt.figure(figsize=(4.5,4.5))
-    axes = plt.subplot(1,1,1)
-
-    plt.axis([-0.05,1.05,-0.05,1.05])
-
-    polys = polygons(P)
-        
-    for poly in polys:
-        p = matplotlib.patches.Polygon(poly, facecolor=np.random.rand(3,1))
-        axes.add_patch(p)
-
-    X,Y = P[:,0],P[:,1]
-    plt.scatter(X, Y, marker='.', zorder=2)
-
-    plt.axis([-0.05,1.05,-0.05,1.05])
-    plt.show()
+    points = np.asarray(points, dtype=np.float64)
+
+    # duplicated points cannot be triangulated
+    unique, inverse = np.unique(points, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    n = len(unique)
+
+    # enclose points and bounds by four far points
+    minimum = unique.min(axis=0)
+    maximum = unique.max(axis=0)
+    if bounds is not None:
+        minimum = np.minimum(minimum, [bounds[0], bounds[2]])
+        maximum = np.maximum(maximum, [bounds[1], bounds[3]])
+    size = np.hypot(*(maximum - minimum))
+    if size == 0:
+        size = 1.
+    if tolerance is None:
+        tolerance = 1e-9 * size
+
+    # work relative to the center
+    center = (minimum + maximum) / 2
+    unique = unique - center
+    ghosts = 3 * size * np.array([[-1., -1.], [1., -1.], [1., 1.], [-1., 1.]])
+
+    delaunay = Delaunay(np.vstack((unique, ghosts)))
+    centers = circumcenters(delaunay.points[delaunay.simplices])
+
+    # each triangle corner links a point to a vertex of its voronoi cell
+    sites = delaunay.simplices.ravel()
+    vertices = np.repeat(np.arange(len(delaunay.simplices)), 3)
+    keep = sites < n
+    sites = sites[keep]
+    vertices = vertices[keep]
+
+    # the cells are convex, so the vertices are ordered by angle around the point
+    delta = centers[vertices] - unique[sites]
+    order = np.lexsort((np.arctan2(delta[:, 1], delta[:, 0]), sites))
+
+    # split into one array per point
+    splits = np.cumsum(np.bincount(sites, minlength=n))[:-1]
+    cells = np.split(centers[vertices[order]] + center, splits)
+
+    # near-duplicates dropped by qhull share the cell of their nearest vertex
+    owner = np.arange(n)
+    coplanar = delaunay.coplanar
+    coplanar = coplanar[coplanar[:, 0] < n]
+    distance = np.hypot(*(unique[coplanar[:, 0]] - delaunay.points[coplanar[:, 2]]).T)
+    if np.any(distance > tolerance):
+        raise ValueError("{0} points were dropped from the triangulation, which are no duplicates within tolerance {1}.".format(int(np.sum(distance > tolerance)), tolerance))
+    owner[coplanar[:, 0]] = coplanar[:, 2]
+
+    return [cells[i] for i in owner[inverse]]